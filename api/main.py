@@ -1,11 +1,147 @@
-import uvicorn
+# startup time is measured from here, see GET /health/ready
+import time
+_import_started = time.perf_counter()
+
 from typing import Annotated, List
-from fastapi import FastAPI, HTTPException, Body, Query
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, Body, Query, Request, Header, Response, Depends
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, FileResponse
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
 from  sqlalchemy.exc import IntegrityError
 from pydantic import BaseModel, Field
-from db import operations
-app = FastAPI()
+# db.consolidation loads numpy, it is imported by its endpoints on first use (like db.analytics)
+from db import operations, changefeed, routing, profiling, idempotency, health
+from contextlib import asynccontextmanager
+import threading
+import inspect
+import logging
+import json
+import math
+
+
+# Sync endpoints run in a thread pool, they are wrapped so profiled requests also record that thread (see db/profiling.py).
+class ProfiledRoute(APIRoute):
+    def __init__(self, path: str, endpoint, **kwargs):
+        if not inspect.iscoroutinefunction(endpoint):
+            endpoint = profiling.profiled(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+
+# The api starts serving right away, the database schema is checked in the background (see db/health.py).
+def _check_schema():
+    errors = health.check_every_site()
+    times = health.startup_times(_import_started, _imported)
+    logger = logging.getLogger("uvicorn.error")
+    if any(errors.values()):
+        logger.warning(f"Not ready: {errors}")
+    else:
+        logger.info(f"Ready in {times['ready_seconds']}s (import {times['import_seconds']}s, schema check {times['schema_check_seconds']})")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    threading.Thread(target=_check_schema, name="schema-check", daemon=True).start()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+app.router.route_class = ProfiledRoute
+
+
+# Every request works on the site (warehouse) given in the X-Site-Id header, or the default site.
+# Reads of a client that just wrote something go to the primary database (see db/routing.py).
+# Clients are told apart by the X-Client-Id header, or by their address if they do not send one. Writes also set a
+# short lived cookie, clients that keep cookies read their writes even when the next request goes to another api process.
+@app.middleware("http")
+async def route_request(request: Request, call_next):
+    site = request.headers.get("X-Site-Id") or routing.DEFAULT_SITE
+    try:
+        routing.check_site(site)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"detail": e.args[0]})
+
+    client = request.headers.get("X-Client-Id") or (request.client.host if request.client else None)
+    site_token = routing.current_site.set(site)
+    client_token = routing.current_client.set(client)
+    pinned_token = routing.current_pinned_until.set(_pinned_until(request))
+    try:
+        # reading the profiles is never profiled, it would fill them with itself
+        if not request.url.path.startswith("/profiles") and profiling.should_profile(request.headers):
+            response = await profile_request(request, call_next)
+        else:
+            response = await call_next(request)
+    finally:
+        routing.current_pinned_until.reset(pinned_token)
+        routing.current_client.reset(client_token)
+        routing.current_site.reset(site_token)
+
+    if _may_have_written(request, response):
+        pinned_until = routing.pin_to_primary(client)
+        if pinned_until is not None:
+            response.set_cookie(routing.PIN_COOKIE, f"{pinned_until:.3f}", max_age=math.ceil(routing.PIN_SECONDS), httponly=True, samesite="lax")
+
+    return response
+
+
+def _pinned_until(request: Request) -> float:
+    try:
+        return float(request.cookies.get(routing.PIN_COOKIE, 0))
+    except ValueError:
+        return 0.0
+
+
+# POST endpoints that only read (their body is too large for a query string), they do not pin the client to the primary.
+READ_ONLY_POSTS = {"/containers/snapshot", "/shelves/snapshot"}
+
+def _may_have_written(request: Request, response) -> bool:
+    if request.method not in ("POST", "PUT", "PATCH", "DELETE") or request.url.path in READ_ONLY_POSTS:
+        return False
+    # rejected requests roll back without writing anything
+    if 400 <= response.status_code < 500:
+        return False
+    # a cycle count only writes when it is applied
+    if request.url.path == "/containers/count":
+        return request.query_params.get("apply", "").lower() in ("1", "true", "yes", "on")
+    return True
+
+
+# Requests sending "X-Profile: <PROFILE_TOKEN>" (or picked by PROFILE_SAMPLE_RATE) record a CPU profile and their SQL statements,
+# the response tells where to download them in the X-Profile-Id header. (see GET /profiles)
+async def profile_request(request: Request, call_next):
+    profile = profiling.RequestProfile(request.method, request.url.path)
+    profile_token = profiling.current_profile.set(profile)
+    profiler = profiling.start_event_loop_profiler(profile)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        if profiler:
+            profiling.stop_event_loop_profiler(profiler)
+        profiling.current_profile.reset(profile_token)
+
+    await run_in_threadpool(profiling.save_profile, profile, response.status_code, time.perf_counter() - start)
+    response.headers["X-Profile-Id"] = profile.profile_id
+    return response
+
+
+# Scanners send an Idempotency-Key header with their writes, so a retry after a dropped connection gets the first
+# response back (with "Idempotent-Replayed: true") instead of writing again. (see db/idempotency.py)
+IdempotencyKeyHeader = Annotated[str | None, Header(alias="Idempotency-Key", min_length=1, max_length=200, description="A unique value (like a UUID) per write, retries with the same value are only applied once")]
+
+def run_idempotent(response: Response, idempotency_key: str | None, endpoint: str, request: dict, function):
+    if idempotency_key is None:
+        return function()
+    try:
+        result, replayed = idempotency.run_once(endpoint, idempotency_key, request, function)
+    except idempotency.KeyReusedError as e:
+        raise HTTPException(status_code=422, detail=e.args[0])
+    except idempotency.KeyInProgressError as e:
+        raise HTTPException(status_code=409, detail=e.args[0])
+
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
 
 ############### Models   ###############
 # request body of a product
@@ -13,6 +149,8 @@ class Product(BaseModel):
     name:str
     description:str 
     additional_product_ids: None | list[dict]  = None
+    unit_size: int = Field(1, gt=0, description="How much of a container's max_capacity a single unit takes")
+    unit_weight: float = Field(0, ge=0, description="How much a single unit weighs, in the same unit as a shelf's max_capacity")
 
 
 class AdditionalIds(BaseModel):
@@ -26,11 +164,23 @@ class Product_Search_Result(BaseModel):
     product_id: int
     additional_ids : None | list[AdditionalIds]
     date_added: str
+    site: None | str = None
 
 #adding a container to a shelf
 class Container_Shelf(BaseModel):
     container_id: str
     shelf_id: str
+
+#a line of a cycle count sheet
+class Count_Line(BaseModel):
+    container_id: str = Field(max_length=50)
+    product_id: str = Field(max_length=50)
+    quantity: int = Field(ge=0)
+
+#moving every product of a container into another one
+class Container_Move(BaseModel):
+    source_container_id: str = Field(max_length=50)
+    target_container_id: str = Field(max_length=50)
     
 
 ############### Products   ###############
@@ -54,6 +204,17 @@ create_prod_examples = {
         "additional_product_ids": [{"identifier_type":"UPC", "identifier_value":"853084004477"}, {"identifier_type":"ASIN", "identifier_value":"B01NBKTPTS"},]
         },
     },
+
+    "sized": {
+    "summary": "With size and weight",
+    "description": "Create a product that takes 4 units of a container's max_capacity and weighs 2.5 (in the unit of the shelves' max_capacity). Containers and shelves refuse products that do not fit.",
+    "value": {
+        "name": "Flexzilla HFZG550YW Garden Lead-In Hose 5/8 In",
+        "description": "Flexzilla Garden Hose is engineered with a Flexible Hybrid Polymer that is both lightweight and durable. ",
+        "unit_size": 4,
+        "unit_weight": 2.5,
+        },
+    },
 }
 create_prod_responses = {
     200:{
@@ -78,7 +239,7 @@ def create_new_product(product: Annotated[Product,Body(openapi_examples=create_p
     """
     try:
         
-        a = operations.create_new_product(name=product.name,description=product.description,additional_product_ids=product.additional_product_ids)
+        a = operations.create_new_product(name=product.name,description=product.description,additional_product_ids=product.additional_product_ids,unit_size=product.unit_size,unit_weight=product.unit_weight)
         return HTMLResponse(content=a)
 
     except IntegrityError as e:
@@ -163,24 +324,41 @@ search_prod_responses = {
             }
         }
     },
+    503:{
+        "description": "Searching every site found nothing, and some sites failed or did not answer in time (listed in the `X-Failed-Sites` header)",
+    },
         
 }
 #search product
 @app.get("/products",responses=search_prod_responses)
-def search_product(search: Annotated[str, Query(min_length=3, )] ) -> list[Product_Search_Result]:
+def search_product(
+    search: Annotated[str, Query(min_length=3, )],
+    all_sites: bool = Query(False, description="Search every site at the same time instead of only the site of the request"),
+) -> list[Product_Search_Result]:
     """Search for a product. 
-    You can search for a product by name or unique id. The search is case-insensitive and will return a list of products that match the search query.
-
+    You can search for a product by name or unique id. The search is case-insensitive and will return a list of products that match the search query.\n
+    With all_sites, sites that fail or do not answer in time are left out of the results and listed in the `X-Failed-Sites` header.
+    It fails with 503 when nothing was found and a site did not answer, the product could be there.
     """
     results = []
-    name_results = operations.search_product_by_name(search)
-    id_results = operations.search_product_by_product_id(search)
-
-    results.extend(name_results)
-    results.extend(id_results)
+    headers = {}
+    if all_sites:
+        found = operations.search_product_in_every_site(search)
+        results.extend(found["products"])
+        if found["failed_sites"]:
+            headers["X-Failed-Sites"] = ",".join(found["failed_sites"])
+            if not results:
+                raise HTTPException(status_code=503, detail=f"Sites that did not answer: {found['failed_sites']}", headers=headers)
+
+    else:
+        name_results = operations.search_product_by_name(search)
+        id_results = operations.search_product_by_product_id(search)
+
+        results.extend(name_results)
+        results.extend(id_results)
 
     if results:
-        return JSONResponse(results)
+        return JSONResponse(results, headers=headers)
 
     raise HTTPException(
         status_code=404,
@@ -206,13 +384,18 @@ create_cont_responses = {
 @app.post("/container", responses=create_cont_responses)
 def crete_container(
     name: str = Query(..., min_length=3, max_length=50, description="Name of the container"),
-    max_capacity: int = Query(..., gt=0, description="Maximum capacity of the container. (There is no real use for this yet, I have not thought of a way to use it.)"),
-    quantity: int = Query(..., gt=0,description="Number of containers to create")
+    max_capacity: int = Query(..., gt=0, description="Maximum capacity of the container, the sum of the unit_size of the products inside it can not go over it."),
+    quantity: int = Query(..., gt=0,description="Number of containers to create"),
+    idempotency_key: IdempotencyKeyHeader = None,
+    response: Response = None,
 ):
     """ Creates a single or multiple containers with the characteristics provided.
 
     """
-    new_containers = operations.create_new_container(name=name, max_capacity=max_capacity, quantity=quantity)
+    new_containers = run_idempotent(
+        response, idempotency_key, "POST /container", {"name": name, "max_capacity": max_capacity, "quantity": quantity},
+        lambda: operations.create_new_container(name=name, max_capacity=max_capacity, quantity=quantity),
+    )
     # return f"Container {new_container} was successfully created"
     return  new_containers
 
@@ -268,18 +451,134 @@ def inspect_container(container_id: Annotated[str, Query(..., min_length=3, max_
     return result
 
 
+#inspect many containers at once
+
+snapshot_containers_examples = {
+    "Multiple": {
+    "summary": "Inspecting multiple containers",
+    "description": "Returns the products inside every container in a single request",
+    "value": ["cf8ddc0c29501413f16c3d5eabeb9a700", "c51441d2f4cfb275bf28c3b4f3c30afce"],
+    },
+}
+@app.post("/containers/snapshot")
+def snapshot_containers(container_ids: Annotated[list[str], Body(description="A list of container ids", openapi_examples=snapshot_containers_examples, max_length=1000)]) -> list[dict]:
+    """Inspects many containers at once. Containers that do not exist are left out.
+    """
+    return operations.snapshot_containers(container_ids)
+
+
+
+#cycle counts
+
+count_examples = {
+    "Shelf": {
+    "summary": "Counting two containers",
+    "description": "Every container in the sheet is considered fully counted, products that are stored in it but missing from the sheet were counted as 0",
+    "value": [
+        {"container_id": "cf8ddc0c29501413f16c3d5eabeb9a700", "product_id": "pfd3c0433307c5aec6139854829f1b008", "quantity": 4},
+        {"container_id": "cf8ddc0c29501413f16c3d5eabeb9a700", "product_id": "p890e865336129d669c9a96d12cd2b9d6", "quantity": 12},
+        {"container_id": "c51441d2f4cfb275bf28c3b4f3c30afce", "product_id": "pfd3c0433307c5aec6139854829f1b008", "quantity": 1},
+        ],
+    },
+}
+count_responses = {
+    200:{
+        "description": "The differences between the count sheet and the stored quantities",
+        "content": {
+            "application/json": {
+                "example": {
+                    "containers": 2,
+                    "lines": 3,
+                    "discrepancies": [{"container_id": "cf8ddc0c29501413f16c3d5eabeb9a700", "product_id": "pfd3c0433307c5aec6139854829f1b008", "expected": 6, "counted": 4, "difference": -2}],
+                    "applied": False,
+                }
+            }
+        }
+    },
+
+}
+@app.post("/containers/count", responses=count_responses)
+def reconcile_cycle_count(
+    lines: Annotated[list[Count_Line], Body(description="The count sheet", openapi_examples=count_examples, max_length=100000)],
+    apply: bool = Query(False, description="Correct the stored quantities to the counted ones (all or nothing)"),
+):
+    """Compares a cycle count sheet with the stored quantities of the counted containers, and optionally corrects them.
+    """
+    try:
+        return operations.reconcile_cycle_count([x.model_dump() for x in lines], apply=apply)
+
+    except IntegrityError:
+        raise HTTPException(status_code=400, detail="The count sheet contains a product or container that does not exist")
+
+
+
+#consolidate half empty containers
+
+consolidation_responses = {
+    200:{
+        "description": "Moves that free the most containers, every product of the source container goes into the target container",
+        "content": {
+            "application/json": {
+                "example": {
+                    "moves": [{"source_container_id": "c51441d2f4cfb275bf28c3b4f3c30afce", "target_container_id": "cf8ddc0c29501413f16c3d5eabeb9a700"}],
+                    "freed_containers": 1,
+                    "empty_containers": 4,
+                    "freed_shelf_slots": 1,
+                    "freed_shelves": ["s4600c099992f81e91b0f1423aa83f7db"],
+                    "zero_quantity_lines": 12,
+                    "planning_seconds": 0.8,
+                }
+            }
+        }
+    },
+
+}
+@app.get("/containers/consolidation", responses=consolidation_responses)
+def plan_consolidation():
+    """Plans how to consolidate half empty containers into as few containers as possible.
+    Nothing is changed, move the products physically and then apply the moves with `POST /containers/consolidation`.
+    """
+    from db import consolidation
+    return consolidation.plan_consolidation()
+
+
+@app.post("/containers/consolidation")
+def apply_consolidation(
+    moves: Annotated[list[Container_Move], Body(description="The moves returned by `GET /containers/consolidation`")],
+    delete_zero_quantity_lines: bool = Query(True, description="Also delete product lines stuck at quantity 0"),
+):
+    """Applies the moves of a consolidation plan in batches.\n
+    Moves that would put a container over its max capacity, or a shelf over its max load, are skipped and listed with the reason.
+    Fails with 400, before anything is moved, if a container does not exist, is moved twice, or is both moved and receiving products.
+    """
+    from db import consolidation
+    try:
+        return consolidation.apply_consolidation([x.model_dump() for x in moves], delete_zero_quantity_lines=delete_zero_quantity_lines)
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=e.args[0])
+
 
 
 @app.post("/containers/product")
 def add_product_to_container(
     product_id : str = Query(..., min_length=3, max_length=50, description="The unique identifier of the product"),
     container_id: str = Query(..., min_length=3, max_length=50, description="The unique identifier of the container"),
-    count: int = Query(..., gt=0, description="Number of products to add to the container")
+    count: int = Query(..., gt=0, description="Number of products to add to the container"),
+    idempotency_key: IdempotencyKeyHeader = None,
+    response: Response = None,
 ):
-    """Add a product to a container.
+    """Add a product to a container.\n
+    Fails with 400 if the container does not have room for them (max_capacity) or its shelf can not hold their weight (max_capacity of the shelf).
     """
-    operations.add_product_to_container(product_id, container_id, count)
-    return f"Product {product_id} added to container {container_id}"
+    def add():
+        operations.add_product_to_container(product_id, container_id, count)
+        return f"Product {product_id} added to container {container_id}"
+
+    try:
+        return run_idempotent(response, idempotency_key, "POST /containers/product", {"product_id": product_id, "container_id": container_id, "count": count}, add)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=e.args[0])
 
 
 
@@ -309,7 +608,7 @@ def remove_product_from_container(
 @app.post("/shelves")
 def create_shelf(
     name: str = Query(..., min_length=3, max_length=50, description="Name of the shelf"),
-    max_capacity: int = Query(..., gt=0, description="Maximum capacity of the shelf. (There is no real use for this yet, I have not thought of a way to use it.)"),
+    max_capacity: int = Query(..., gt=0, description="Maximum load of the shelf, the weight (unit_weight) of the products in its containers can not go over it."),
     # quantity: int = Query(..., gt=0,description="Number of shelves to create") (to be implemented)
 
 ):
@@ -350,11 +649,60 @@ def delete_shelves(shelf_id:  Annotated[list[str], Body(description="A list of u
 #inspect shelf
 
 @app.get("/shelves")
-def inspect_shelf(shelf_id =  Query(description="The id of the container to be searched")):
+def inspect_shelf(
+    shelf_id =  Query(description="The id of the container to be searched"),
+    deep: bool = Query(False, description="Also return every container on the shelf with the products inside it"),
+):
+    if deep:
+        shelves = operations.snapshot_shelves([shelf_id])
+        if not shelves:
+            raise HTTPException(status_code=404, detail=f"Shelf `{shelf_id}` does not exist")
+        return shelves[0]
+
     contents = operations.inspect_shelf_containers(shelf_id)
     return {"containers":contents}
 
 
+#inspect many shelves at once
+
+snapshot_shelves_examples = {
+    "Aisle": {
+    "summary": "Inspecting every shelf of an aisle",
+    "description": "Returns every shelf with its containers and the products inside them in a single request",
+    "value": ["s4600c099992f81e91b0f1423aa83f7db", "s223cd0ed5e0570b800cc6578b6b451f0"],
+    },
+}
+snapshot_shelves_responses = {
+    200:{
+        "description": "The shelves found, shelves that do not exist are left out",
+        "content": {
+            "application/json": {
+                "example": [{
+                    "shelf_id": "s4600c099992f81e91b0f1423aa83f7db",
+                    "shelf_name": "A1",
+                    "max_load_capacity": 100,
+                    "used_load_capacity": 2.4,
+                    "containers": [{
+                        "container_id": "cf8ddc0c29501413f16c3d5eabeb9a700",
+                        "container_name": "Small tote",
+                        "max_capacity": 20,
+                        "used_capacity": 4,
+                        "content_weight": 2.4,
+                        "products": [{"product_id": "pfd3c0433307c5aec6139854829f1b008", "product_name": "Pliers", "quantity": 4}],
+                    }],
+                }]
+            }
+        }
+    },
+
+}
+@app.post("/shelves/snapshot", responses=snapshot_shelves_responses)
+def snapshot_shelves(shelf_ids: Annotated[list[str], Body(description="A list of unique shelf identifiers", openapi_examples=snapshot_shelves_examples, max_length=1000)]):
+    """Inspects many shelves at once, with their containers and the products inside every container.
+    """
+    return operations.snapshot_shelves(shelf_ids)
+
+
 #add container to shelf
 
 add_container_examples = {
@@ -389,11 +737,24 @@ add_container_examples = {
     },
 }
 @app.post("/shelves/container")
-def add_containers_to_shelves(containers: Annotated[list[Container_Shelf], Body(description="A list of containers to add to the shelf",openapi_examples=add_container_examples)]):   
-    """Adds containers to shelves.
+def add_containers_to_shelves(
+    containers: Annotated[list[Container_Shelf], Body(description="A list of containers to add to the shelf",openapi_examples=add_container_examples)],
+    idempotency_key: IdempotencyKeyHeader = None,
+    response: Response = None,
+):
+    """Adds containers to shelves.\n
+    Fails with 400 (and no container is added) if a shelf can not hold the weight of its new containers (max_capacity of the shelf).
     """
-    operations.add_containers_to_shelf(containers)
-    return {"message": "Containers added to shelf"}
+    containers = [x.model_dump() for x in containers]
+
+    def add():
+        operations.add_containers_to_shelf(containers)
+        return {"message": "Containers added to shelf"}
+
+    try:
+        return run_idempotent(response, idempotency_key, "POST /shelves/container", containers, add)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=e.args[0])
 
 
 
@@ -421,8 +782,248 @@ def remove_container_from_shelf(
 
 
 
+############### Sync       ###############
+
+sync_responses = {
+    200:{
+        "description": "The rows that changed since the cursor. Rows are sent as lists, `columns` gives the name of every value.",
+        "content": {
+            "application/json": {
+                "example": {
+                    "cursor": "1290-77",
+                    "has_more": False,
+                    "columns": {
+                        "container_contents": ["content_id", "container_id", "product_id", "quantity"],
+                    },
+                    "changes": {
+                        "container_contents": [[12, "cf8ddc0c29501413f16c3d5eabeb9a700", "pfd3c0433307c5aec6139854829f1b008", 5]],
+                    },
+                    "deleted": {
+                        "shelf_containers": ["7"],
+                    },
+                }
+            }
+        }
+    },
+
+}
+@app.get("/sync", responses=sync_responses)
+def sync(
+    since: str | None = Query(None, max_length=50, description="The cursor returned by the previous sync. Leave empty to download everything."),
+    limit: int = Query(1000, gt=0, le=10000, description="Maximum number of changed rows to return"),
+):
+    """Delta sync for offline devices.
+    Returns only the rows created, updated or deleted since the cursor. Keep calling with the returned `cursor` until `has_more` is false.
+    """
+    try:
+        return operations.sync_changes(cursor=since, limit=limit)
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=e.args[0])
+
+
+
+############### Analytics  ###############
+
+analytics_responses = {
+    200:{
+        "description": "Inventory rollups served from a cache, `as_of` and `age_seconds` tell how fresh they are",
+        "content": {
+            "application/json": {
+                "example": {
+                    "computed_at": "2025-01-08T03:43:33.850485+00:00",
+                    "as_of": "2025-01-08T03:48:33.850485+00:00",
+                    "age_seconds": 12.5,
+                    "stale": False,
+                    "computation_seconds": 0.4,
+                    "totals": {"containers": 120, "empty_containers": 8, "shelved_containers": 100, "products_in_stock": 42, "units": 2310},
+                    "shelves": [{"shelf_id": "s4600c099992f81e91b0f1423aa83f7db", "containers": 10, "units": 130, "used_capacity": 130, "capacity": 200, "load": 52.5, "load_utilization": 0.525, "utilization": 0.65}],
+                    "products": [{"product_id": "pfd3c0433307c5aec6139854829f1b008", "product_name": "Pliers", "on_hand": 40, "containers": 3, "last_change": "2025-01-02T10:12:00.000000"}],
+                    "fill_distribution": [{"from": 0.0, "to": 0.1, "containers": 8}, {"from": 1.0, "to": None, "containers": 0}],
+                    "slow_movers": [{"product_id": "p890e865336129d669c9a96d12cd2b9d6", "product_name": "Hose", "on_hand": 5, "containers": 1, "last_change": "2024-10-02T10:12:00.000000"}],
+                }
+            }
+        }
+    },
+
+}
+@app.get("/analytics", responses=analytics_responses)
+def get_analytics():
+    """Per shelf utilization, per product stock, container fill levels and slow movers.
+    Served from a cache that is refreshed in the background, it never scans the inventory tables on request.
+    """
+    from db import analytics
+    return analytics.get_rollups()
+
+
+
+############### Replicas   ###############
+
+@app.get("/replicas")
+def replicas() -> list[dict]:
+    """Shows the lag of every read replica. Replicas that are unreachable or too far behind are not used.
+    """
+    return routing.replica_status()
+
+
+
+############### Change feed ###############
+
+changes_responses = {
+    200:{
+        "description": "A stream of Server-Sent Events, one event per change. A `resync` event means some changes were missed and the data should be reloaded.",
+        "content": {
+            "text/event-stream": {
+                "example": 'event: container_content\ndata: {"entity": "container_content", "action": "upsert", "container_id": "cf8ddc0c29501413f16c3d5eabeb9a700", "product_id": "pfd3c0433307c5aec6139854829f1b008", "shelf_id": "s4600c099992f81e91b0f1423aa83f7db", "quantity": 12}\n\n'
+            }
+        }
+    },
+
+}
+@app.get("/changes", responses=changes_responses)
+async def stream_changes(
+    request: Request,
+    container_id: str | None = Query(None, min_length=3, max_length=50, description="Only receive changes of this container"),
+    shelf_id: str | None = Query(None, min_length=3, max_length=50, description="Only receive changes of this shelf"),
+    product_id: str | None = Query(None, min_length=3, max_length=50, description="Only receive changes of this product"),
+):
+    """Streams inventory changes as they happen (Server-Sent Events).
+    Use this instead of polling `GET /containers` and `GET /shelves`. If a client falls behind, changes to the same row are merged and only the latest one is sent.
+    """
+    subscriber = changefeed.subscribe(container_id=container_id, shelf_id=shelf_id, product_id=product_id)
+
+    async def events():
+        try:
+            while not await request.is_disconnected():
+                batch = await subscriber.next_batch(timeout=15)
+
+                # keeps proxies from closing an idle connection
+                if not batch:
+                    yield ": keep-alive\n\n"
+                    continue
+
+                for change in batch:
+                    yield f"event: {change['entity']}\ndata: {json.dumps(change)}\n\n"
+        finally:
+            changefeed.unsubscribe(subscriber)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+
+############### Profiles   ###############
+
+profile_responses = {
+    200:{
+        "description": "How long the request took, every SQL statement it ran and the functions it spent the most time in",
+        "content": {
+            "application/json": {
+                "example": {
+                    "profile_id": "20250108T034333-9f2c61aa",
+                    "method": "GET",
+                    "path": "/containers",
+                    "status_code": 200,
+                    "started_at": "2025-01-08T03:43:33.850485+00:00",
+                    "ms": 18.2,
+                    "sql_ms": 11.4,
+                    "sql_statements": 1,
+                    "pool_wait_ms": 0.1,
+                    "has_pstats": True,
+                    "statements": [{"statement": "SELECT containers.container_id, ... WHERE containers.container_id = %(container_id_1)s", "ms": 11.4, "rows": 3}],
+                    "top_functions": [{"function": "/code/db/operations.py:344(inspect_container)", "calls": 1, "own_ms": 0.05, "cumulative_ms": 15.9}],
+                }
+            }
+        }
+    },
+    403:{
+        "description": "The `X-Profile` header is missing or is not the PROFILE_TOKEN",
+    },
+    404:{
+        "description": "The profile does not exist or was deleted to make room for newer ones",
+    },
+
+}
+# profiles hold the SQL statements of every client, only holders of the PROFILE_TOKEN can read them
+def require_profile_token(request: Request):
+    if not profiling.has_profile_token(request.headers):
+        raise HTTPException(status_code=403, detail="Send the PROFILE_TOKEN in the X-Profile header to read profiles")
+
+
+@app.get("/profiles", dependencies=[Depends(require_profile_token)])
+def list_profiles() -> list[dict]:
+    """Lists the profiled requests, newest first.
+    Send the header `X-Profile: <PROFILE_TOKEN>` with any request to profile it, the id of its profile comes back in the `X-Profile-Id` header.
+    """
+    return profiling.list_profiles()
+
+
+@app.get("/profiles/{profile_id}", responses=profile_responses, dependencies=[Depends(require_profile_token)])
+def get_profile(profile_id: str):
+    """The SQL statements and slowest functions of a profiled request.
+    """
+    profile = profiling.get_profile(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"Profile {profile_id} not found")
+    return profile
+
+
+@app.get("/profiles/{profile_id}/pstats", dependencies=[Depends(require_profile_token)])
+def download_profile(profile_id: str):
+    """Downloads the CPU profile of a profiled request, open it with `python -m pstats` or snakeviz.
+    """
+    path = profiling.profile_path(profile_id, "prof")
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"Profile {profile_id} not found")
+    return FileResponse(path, media_type="application/octet-stream", filename=f"{profile_id}.prof")
+
+
+
+############### Health     ###############
+
+@app.get("/health/live")
+def live():
+    """Liveness probe, answers as long as the process is running. Never touches the database.
+    """
+    return {"status": "alive"}
+
+
+ready_responses = {
+    200:{
+        "description": "Every site is reachable and has the schema this version of the api expects",
+        "content": {
+            "application/json": {
+                "example": {
+                    "status": "ready",
+                    "sites": {"default": None},
+                    "startup": {"import_seconds": 0.9, "ready_seconds": 1.1, "schema_check_seconds": {"default": 0.004}},
+                }
+            }
+        }
+    },
+    503:{
+        "description": "A site is unreachable or its schema is behind, `sites` has the error of every site",
+    },
+
+}
+@app.get("/health/ready", responses=ready_responses)
+def ready():
+    """Readiness probe, checks the schema of every site (once) and pings every primary database.
+    """
+    errors = health.check_every_site()
+    content = {
+        "status": "not ready" if any(errors.values()) else "ready",
+        "sites": errors,
+        "startup": health.startup_times(_import_started, _imported),
+    }
+    return JSONResponse(status_code=503 if any(errors.values()) else 200, content=content)
+
+
+
 #     return
 # TODOs 
 
+_imported = time.perf_counter()
+
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, port=8000)
\ No newline at end of file
@@ -0,0 +1,73 @@
+# Compares two saved runs of the same benchmark, exits with 1 if any benchmark got slower than the threshold.
+#   python -m benchmarks.compare results/operations-main.json results/operations-branch.json --threshold 10
+import argparse
+import json
+import sys
+
+METRICS = ["p50_ms", "p95_ms", "p99_ms", "throughput"]
+
+
+def _change(before: float, after: float) -> float:
+    """Returns how much a value changed, in percent of the old one."""
+    return (after - before) / before * 100 if before else 0.0
+
+
+def compare(baseline: dict, candidate: dict, threshold: float, metric: str = "p95_ms") -> tuple[list[dict], list[str]]:
+    """Compares every benchmark found in both runs.
+
+    Args:
+        baseline (dict): The saved run to compare against (see benchmarks.results.save()).
+        candidate (dict): The new saved run.
+        threshold (float): How many percent slower `metric` may get before it counts as a regression.
+        metric (str): The latency that decides regressions.
+
+    Returns:
+        tuple[list[dict], list[str]]: One row per benchmark with the change of every metric in percent, and the names of the regressed benchmarks.
+    """
+    if baseline["kind"] != candidate["kind"]:
+        raise SystemExit(f"Can not compare a `{baseline['kind']}` run with a `{candidate['kind']}` run")
+
+    rows = []
+    regressions = []
+    for name, before in baseline["results"].items():
+        after = candidate["results"].get(name)
+        if not after or not before.get("count") or not after.get("count"):
+            continue
+
+        row = {"benchmark": name}
+        for x in METRICS:
+            row[x] = (before[x], after[x], _change(before[x], after[x]))
+        rows.append(row)
+
+        if _change(before[metric], after[metric]) > threshold:
+            regressions.append(name)
+
+    return rows, regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares two saved benchmark runs.")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10, help="percent a latency may grow before it counts as a regression")
+    parser.add_argument("--metric", default="p95_ms", choices=["p50_ms", "p95_ms", "p99_ms"])
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    rows, regressions = compare(baseline, candidate, args.threshold, args.metric)
+
+    print(f"baseline:  {baseline['git_commit']} {baseline['created_at']}")
+    print(f"candidate: {candidate['git_commit']} {candidate['created_at']}")
+    print(f"{'benchmark':<32}" + "".join(f"{x:>30}" for x in METRICS))
+    for row in rows:
+        cells = "".join(f"{f'{row[x][0]} -> {row[x][1]} ({row[x][2]:+.0f}%)':>30}" for x in METRICS)
+        marker = "  REGRESSION" if row["benchmark"] in regressions else ""
+        print(f"{row['benchmark']:<32}{cells}{marker}")
+
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) got more than {args.threshold}% slower ({args.metric}): {', '.join(regressions)}")
+        sys.exit(1)
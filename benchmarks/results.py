@@ -0,0 +1,77 @@
+from datetime import datetime, timezone
+import subprocess
+import platform
+import json
+import os
+
+
+def summarize(latencies: list[float], seconds: float | None = None, errors: int = 0) -> dict:
+    """Summarizes a list of latencies (in seconds).
+
+    Args:
+        latencies (list[float]): How long every call took.
+        seconds (float | None): How long the whole run took, used for the throughput. Defaults to the sum of the latencies.
+        errors (int): How many calls failed.
+
+    Returns:
+        dict: Example: {"count": 1000, "errors": 0, "mean_ms": 1.2, "p50_ms": 1.1, "p95_ms": 2.0, "p99_ms": 3.4, "max_ms": 8.1, "throughput": 830.5}
+    """
+    if not latencies:
+        return {"count": 0, "errors": errors}
+
+    ordered = sorted(latencies)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000
+
+    seconds = seconds or sum(latencies)
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "p50_ms": round(percentile(50), 3),
+        "p95_ms": round(percentile(95), 3),
+        "p99_ms": round(percentile(99), 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+        "throughput": round(len(latencies) / seconds, 1),
+    }
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def save(path: str, kind: str, settings: dict, results: dict):
+    """Saves the results of a benchmark run as JSON, with what is needed to compare it with other runs.
+
+    Args:
+        path (str): Where to save the results. Example: "results/operations-main.json"
+        kind (str): The benchmark that was run. Example: "operations" or "load"
+        settings (dict): The arguments of the run.
+        results (dict): One summary (see summarize()) per benchmark.
+    """
+    document = {
+        "kind": kind,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "settings": settings,
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(document, f, indent=4)
+
+
+def print_table(results: dict):
+    """Prints the results of a run as a table."""
+    print(f"{'benchmark':<32}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ops/s':>10}")
+    for name, x in results.items():
+        if not x.get("count"):
+            print(f"{name:<32}{0:>8}{x.get('errors', 0):>8}")
+            continue
+        print(f"{name:<32}{x['count']:>8}{x['errors']:>8}{x['p50_ms']:>10}{x['p95_ms']:>10}{x['p99_ms']:>10}{x['throughput']:>10}")
@@ -0,0 +1,272 @@
+from db.dbconfig import (
+    Container,
+    Product,
+    Shelf,
+    ShelfContainer,
+    ContainerContent,
+    Tombstone,
+)
+from db.routing import read_engine, write_engine, current_site
+from sqlalchemy.orm import Session
+from sqlalchemy import (
+    Float,
+    func,
+    select,
+    distinct,
+    tuple_,
+    text,
+    cast,
+    case,
+)
+from datetime import datetime, timedelta, timezone
+import threading
+import time
+
+# Dashboards are served from a cache that is refreshed in the background every REFRESH_SECONDS, so they never
+# scan container_contents, shelf_containers and shelves themselves. Refreshing is skipped while nothing changed
+# (no transaction wrote to the tables since the snapshot the rollups were computed from), and the rollups are
+# computed on a read replica when there is one.
+
+# How often the rollups of every site are refreshed.
+REFRESH_SECONDS = 300
+
+# Products that still have stock but did not move for this many days are slow movers.
+SLOW_MOVER_DAYS = 30
+
+# How many slow movers are returned, the ones that have not moved for the longest first.
+SLOW_MOVERS_LIMIT = 100
+
+# Rollups are recomputed at least this often even if nothing changed, products become slow movers with time.
+MAX_AGE = timedelta(hours=1)
+
+# site -> the last rollups computed for it
+_cache: dict[str, dict] = {}
+_cache_lock = threading.Lock()
+_refresher: threading.Thread | None = None
+
+
+############# Rollups #################
+
+# The tables the rollups read, a change to any of them (or a deletion, see Tombstone) makes the rollups outdated.
+ROLLUP_TABLES = [Product, Container, ContainerContent, Shelf, ShelfContainer, Tombstone]
+
+
+def _compute_rollups() -> tuple[dict, str]:
+    """Computes every rollup of the current site, the aggregation runs in the database and only its rows are fetched.\n
+    Containers are grouped per shelf, per fill level and all together by a single GROUPING SETS query, products by another.
+    Both see the same snapshot of the database, which is returned with the rollups (see _changed_since).
+    """
+    units = (
+        select(ContainerContent.container_id, func.sum(ContainerContent.quantity).label("units"))
+        .group_by(ContainerContent.container_id)
+        .subquery()
+    )
+    fill = cast(Container.used_capacity, Float) / Container.max_capacity
+    containers = (
+        select(
+            Container.max_capacity,
+            Container.used_capacity,
+            Container.content_weight,
+            ShelfContainer.shelf_id,
+            Shelf.max_load_capacity,
+            func.coalesce(units.c.units, 0).label("units"),
+            # how full the container is, in steps of 10% from 1 to 10, 11 for containers over their max_capacity
+            case((fill > 1, 11), else_=func.least(func.width_bucket(fill, 0, 1, 10), 10)).label("fill_bucket"),
+        )
+        .outerjoin(units, units.c.container_id == Container.container_id)
+        .outerjoin(ShelfContainer, ShelfContainer.container_id == Container.container_id)
+        .outerjoin(Shelf, Shelf.shelf_id == ShelfContainer.shelf_id)
+        .subquery()
+    )
+    c = containers.c
+    container_stmt = (
+        select(
+            # 0 for the rows grouped by shelf, and for the rows grouped by fill level
+            func.grouping(c.shelf_id).label("not_by_shelf"),
+            func.grouping(c.fill_bucket).label("not_by_fill"),
+            c.shelf_id,
+            c.max_load_capacity,
+            c.fill_bucket,
+            func.count().label("containers"),
+            func.count().filter(c.units == 0).label("empty_containers"),
+            func.count(c.shelf_id).label("shelved_containers"),
+            func.coalesce(func.sum(c.units), 0).label("units"),
+            func.coalesce(func.sum(c.used_capacity), 0).label("used_capacity"),
+            func.coalesce(func.sum(c.max_capacity), 0).label("capacity"),
+            func.coalesce(func.sum(c.content_weight), 0).label("load"),
+        )
+        .group_by(func.grouping_sets(tuple_(c.shelf_id, c.max_load_capacity), tuple_(c.fill_bucket), tuple_()))
+    )
+    product_stmt = (
+        select(
+            ContainerContent.product_id,
+            Product.product_name,
+            func.sum(ContainerContent.quantity).label("units"),
+            func.count(distinct(ContainerContent.container_id)).filter(ContainerContent.quantity > 0).label("containers"),
+            func.max(ContainerContent.updated_at).label("last_change"),
+            (func.max(ContainerContent.updated_at) < func.now() - timedelta(days=SLOW_MOVER_DAYS)).label("is_slow"),
+        )
+        .join(Product, Product.product_id == ContainerContent.product_id)
+        .group_by(ContainerContent.product_id, Product.product_name)
+    )
+
+    with Session(read_engine()) as session:
+        # both queries and the snapshot see the database at the same moment
+        session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+        rows = session.execute(container_stmt).all()
+        products = session.execute(product_stmt).all()
+        snapshot = session.scalar(text("SELECT pg_current_snapshot()::text"))
+
+    shelves = []
+    fill_counts = {}
+    totals = None
+    for x in rows:
+        if not x.not_by_shelf and x.shelf_id is not None:
+            shelves.append({
+                "shelf_id": x.shelf_id,
+                "containers": x.containers,
+                "units": x.units,
+                "used_capacity": x.used_capacity,
+                "capacity": x.capacity,
+                # what the containers weigh, the load they reserve (Shelf.reserved_load) can be higher
+                "load": round(x.load, 3),
+                "load_utilization": round(x.load / x.max_load_capacity, 4) if x.max_load_capacity else 0,
+                "utilization": round(x.used_capacity / x.capacity, 4) if x.capacity else 0,
+            })
+        elif not x.not_by_fill:
+            fill_counts[x.fill_bucket] = x.containers
+        elif x.not_by_shelf and x.not_by_fill:
+            totals = x
+
+    # in steps of 10% (the last bucket holds containers over their max_capacity)
+    fill_distribution = [{"from": i / 10, "to": (i + 1) / 10, "containers": fill_counts.get(i + 1, 0)} for i in range(10)]
+    fill_distribution.append({"from": 1.0, "to": None, "containers": fill_counts.get(11, 0)})
+
+    slow_movers = sorted((x for x in products if x.is_slow and x.units > 0), key=lambda x: x.last_change)[:SLOW_MOVERS_LIMIT]
+
+    def product_rollup(x):
+        return {
+            "product_id": x.product_id,
+            "product_name": x.product_name,
+            "on_hand": x.units,
+            "containers": x.containers,
+            "last_change": x.last_change.isoformat() if x.last_change else None,
+        }
+
+    rollups = {
+        "totals": {
+            "containers": totals.containers,
+            "empty_containers": totals.empty_containers,
+            "shelved_containers": totals.shelved_containers,
+            "products_in_stock": sum(1 for x in products if x.units > 0),
+            "units": totals.units,
+        },
+        "shelves": sorted(shelves, key=lambda x: x["shelf_id"]),
+        "products": [product_rollup(x) for x in products],
+        "fill_distribution": fill_distribution,
+        "slow_movers": [product_rollup(x) for x in slow_movers],
+    }
+    return rollups, snapshot
+
+
+def _changed_since(snapshot: str) -> bool:
+    """Returns True if a transaction the snapshot did not see has since written to a table the rollups read.\n
+    Checked on the primary, which has every committed write. Transaction ids are the same on the primary and its replicas,
+    so the snapshot can come from a replica. Writes are found through their change_xid (the ix_*_change indexes), the
+    transactions still running then are caught by the next refresh.
+    """
+    # transactions older than the snapshot's xmin had all finished when it was taken
+    unseen = " OR ".join(
+        f"""EXISTS (SELECT 1 FROM {table.__tablename__}
+            WHERE change_xid >= pg_snapshot_xmin(CAST(:snapshot AS pg_snapshot))::text::bigint
+            AND NOT pg_visible_in_snapshot(change_xid::text::xid8, CAST(:snapshot AS pg_snapshot)))"""
+        for table in ROLLUP_TABLES
+    )
+    with Session(write_engine()) as session:
+        return session.scalar(text(f"SELECT {unseen}"), {"snapshot": snapshot})
+
+
+def refresh_rollups(site: str | None = None):
+    """Recomputes the rollups of a site, unless nothing was written since they were last computed (and they are younger than MAX_AGE).
+
+    Args:
+        site (str | None): Defaults to the current site.
+    """
+    site = site or current_site.get()
+    token = current_site.set(site)
+    try:
+        now = datetime.now(timezone.utc)
+        cached = _cache.get(site)
+
+        if cached and now - cached["computed_at"] < MAX_AGE and not _changed_since(cached["snapshot"]):
+            with _cache_lock:
+                cached["as_of"] = now
+            return
+
+        start = time.perf_counter()
+        rollups, snapshot = _compute_rollups()
+
+        with _cache_lock:
+            _cache[site] = {
+                "rollups": rollups,
+                "snapshot": snapshot,
+                "computed_at": now,
+                "as_of": now,
+                "computation_seconds": round(time.perf_counter() - start, 3),
+            }
+    finally:
+        current_site.reset(token)
+
+
+def get_rollups() -> dict:
+    """Returns the cached rollups of the current site, computing them first if this site was never asked for.
+
+    Returns:
+        dict: The rollups and how old they are. Example:\n
+        {
+            "computed_at": "2025-01-08T03:43:33.850485+00:00",  # when the rollups were last computed
+            "as_of": "2025-01-08T03:48:33.850485+00:00",        # when they were last confirmed to be current
+            "age_seconds": 12.5,                                 # seconds since as_of
+            "stale": False,                                      # True if the background refresh fell behind
+            "computation_seconds": 0.4,
+            "totals": {...}, "shelves": [...], "products": [...], "fill_distribution": [...], "slow_movers": [...],
+        }
+    """
+    site = current_site.get()
+    if site not in _cache:
+        refresh_rollups(site)
+    _start_refresher()
+
+    cached = _cache[site]
+    age = (datetime.now(timezone.utc) - cached["as_of"]).total_seconds()
+
+    return {
+        "computed_at": cached["computed_at"].isoformat(),
+        "as_of": cached["as_of"].isoformat(),
+        "age_seconds": round(age, 1),
+        "stale": age > 2 * REFRESH_SECONDS,
+        "computation_seconds": cached["computation_seconds"],
+        **cached["rollups"],
+    }
+
+
+############# Background refresh #################
+
+def _refresh_forever():
+    while True:
+        time.sleep(REFRESH_SECONDS)
+        for site in list(_cache):
+            try:
+                refresh_rollups(site)
+            except Exception:
+                # keep serving the old rollups, they will show up as stale
+                pass
+
+
+def _start_refresher():
+    global _refresher
+
+    with _cache_lock:
+        if _refresher is None:
+            _refresher = threading.Thread(target=_refresh_forever, name="analytics-refresh", daemon=True)
+            _refresher.start()
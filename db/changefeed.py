@@ -0,0 +1,212 @@
+from db.dbconfig import site_engines
+from db.routing import current_site
+from sqlalchemy.orm import Session
+from sqlalchemy import text
+from collections import OrderedDict
+import asyncio
+import threading
+import select
+import json
+import time
+
+# Every write in db/operations.py publishes its changes on this channel. Postgres only delivers
+# the notifications once the transaction commits, so subscribers never see rolled back changes.
+# https://www.postgresql.org/docs/current/sql-notify.html
+CHANNEL = "inventory_changes"
+
+# How many pending (not yet delivered) changes a single subscriber can hold before the oldest ones
+# are dropped and the subscriber is told to resync.
+MAX_PENDING_CHANGES = 1000
+
+
+############# Publishing #################
+
+def publish_changes(session: Session, changes: list[dict]):
+    """Queues a list of changes to be sent to the listeners of the change feed.\n
+    Must be called with the same session that performed the write, the changes are only sent when that session commits.
+
+    Args:
+        session (Session): The session that performed the write.
+        changes (list[dict]): A list of python dictionaries that look like the following:\n
+        changes = [
+            {"entity": "container_content", "action": "upsert",
+            "container_id": "cf8ddc0c29501413f16c3d5eabeb9a700",
+            "product_id": "pfd3c0433307c5aec6139854829f1b008",
+            "shelf_id": "s4600c099992f81e91b0f1423aa83f7db",
+            "quantity": 12},
+        ]
+    """
+    if not changes:
+        return
+
+    # A single round trip no matter how many changes there are.
+    stmt = text("SELECT pg_notify(:channel, payload) FROM unnest(CAST(:payloads AS text[])) AS payload")
+    session.execute(stmt, {"channel": CHANNEL, "payloads": [json.dumps(x) for x in changes]})
+
+
+############# Subscribers #################
+
+class Subscriber:
+    """A single client of the change feed.\n
+    Changes are coalesced per row, if a row changes several times before the client reads it, only the latest version is delivered.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, site: str, container_id: str | None = None, shelf_id: str | None = None, product_id: str | None = None, max_pending: int = MAX_PENDING_CHANGES):
+        self.loop = loop
+        self.site = site
+        self.container_id = container_id
+        self.shelf_id = shelf_id
+        self.product_id = product_id
+        self.max_pending = max_pending
+
+        self._pending = OrderedDict()
+        self._overflowed = False
+        self._wakeup = asyncio.Event()
+
+    def matches(self, change: dict) -> bool:
+        """Returns True if the change passes every filter of this subscriber."""
+        # feed events (resync) concern everyone
+        if change.get("entity") == "feed":
+            return True
+        if self.container_id and change.get("container_id") != self.container_id:
+            return False
+        if self.shelf_id and change.get("shelf_id") != self.shelf_id:
+            return False
+        if self.product_id and change.get("product_id") != self.product_id:
+            return False
+        return True
+
+    def push(self, change: dict):
+        """Adds a change to the pending changes of this subscriber. (Must run on the subscriber's event loop)"""
+        key = (change.get("entity"), change.get("container_id"), change.get("product_id"), change.get("shelf_id"))
+
+        # move the row to the end so the delivery order follows the latest change
+        self._pending.pop(key, None)
+        self._pending[key] = change
+
+        # slow client, drop the oldest change and let the client know it missed something
+        if len(self._pending) > self.max_pending:
+            self._pending.popitem(last=False)
+            self._overflowed = True
+
+        self._wakeup.set()
+
+    async def next_batch(self, timeout: float) -> list[dict]:
+        """Waits for pending changes and returns all of them.
+
+        Args:
+            timeout (float): How many seconds to wait for changes.
+
+        Returns:
+            list[dict]: The pending changes, an empty list if nothing changed before the timeout.
+        """
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+
+        self._wakeup.clear()
+        batch = list(self._pending.values())
+        self._pending.clear()
+
+        if self._overflowed:
+            self._overflowed = False
+            batch.insert(0, {"entity": "feed", "action": "resync"})
+
+        return batch
+
+
+_subscribers: set[Subscriber] = set()
+_subscribers_lock = threading.Lock()
+# one listener per site, every site publishes its changes in its own database
+_listeners: dict[str, threading.Thread] = {}
+
+
+def subscribe(container_id: str | None = None, shelf_id: str | None = None, product_id: str | None = None) -> Subscriber:
+    """Registers a new subscriber (for the current site) on the running event loop and starts the listener of the site if needed.
+
+    Args:
+        container_id (str | None): Only receive changes of this container.
+        shelf_id (str | None): Only receive changes of this shelf.
+        product_id (str | None): Only receive changes of this product.
+
+    Returns:
+        Subscriber: The new subscriber, remember to call unsubscribe() when the client goes away.
+    """
+    site = current_site.get()
+    subscriber = Subscriber(asyncio.get_running_loop(), site, container_id=container_id, shelf_id=shelf_id, product_id=product_id)
+
+    with _subscribers_lock:
+        _subscribers.add(subscriber)
+
+        if site not in _listeners:
+            _listeners[site] = threading.Thread(target=_listen, args=(site,), name=f"changefeed-listener-{site}", daemon=True)
+            _listeners[site].start()
+
+    return subscriber
+
+
+def unsubscribe(subscriber: Subscriber):
+    """Removes a subscriber from the change feed."""
+    with _subscribers_lock:
+        _subscribers.discard(subscriber)
+
+
+def _dispatch(site: str, change: dict):
+    """Hands a change made in a site to every subscriber interested in it."""
+    with _subscribers_lock:
+        subscribers = [x for x in _subscribers if x.site == site and x.matches(change)]
+
+    for subscriber in subscribers:
+        try:
+            subscriber.loop.call_soon_threadsafe(subscriber.push, change)
+        except RuntimeError:
+            # the event loop of this subscriber is closed
+            unsubscribe(subscriber)
+
+
+############# Listener #################
+
+def _listen(site: str):
+    """Runs forever on a background thread, receives notifications from the database of a site and dispatches them to the subscribers."""
+    reconnecting = False
+
+    while True:
+        raw = None
+        try:
+            # a dedicated connection, LISTEN would otherwise hold a pooled connection forever.
+            # https://docs.sqlalchemy.org/en/20/core/pooling.html#sqlalchemy.pool.PoolProxiedConnection.detach
+            raw = site_engines[site].raw_connection()
+            raw.detach()
+            connection = raw.dbapi_connection
+            connection.autocommit = True
+
+            # https://www.psycopg.org/docs/advanced.html#asynchronous-notifications
+            with connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANNEL}")
+
+            # anything published while we were disconnected is lost, clients have to reload
+            if reconnecting:
+                _dispatch(site, {"entity": "feed", "action": "resync"})
+
+            while True:
+                # wakes up as soon as a notification arrives, the timeout only exists to notice dead connections
+                if select.select([connection], [], [], 30) == ([], [], []):
+                    with connection.cursor() as cursor:
+                        cursor.execute("SELECT 1")
+                    continue
+
+                connection.poll()
+                while connection.notifies:
+                    notification = connection.notifies.pop(0)
+                    _dispatch(site, json.loads(notification.payload))
+
+        except Exception:
+            # lost the connection to the database, try again in a bit
+            reconnecting = True
+            if raw is not None:
+                try:
+                    raw.close()
+                except Exception:
+                    pass
+            time.sleep(1)
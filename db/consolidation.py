@@ -0,0 +1,353 @@
+from db.dbconfig import (
+    Container,
+    ContainerContent,
+    ShelfContainer,
+)
+from db.changefeed import publish_changes
+from db.operations import record_tombstones, lock_containers, refresh_totals
+from db.routing import read_engine, write_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import (
+    Table,
+    Column,
+    MetaData,
+    String,
+    func,
+    select,
+    insert,
+    update,
+    delete,
+    exists,
+)
+import numpy as np
+import bisect
+import time
+
+# Consolidation moves every product of a half empty container into another container that has room for it,
+# so the emptied containers (and the shelf slots they use) can be reused.
+# A move always empties the whole source container, product lines are never split between containers.
+
+# How many moves are applied per transaction, keeps locks short while staff keep working.
+MOVES_PER_BATCH = 500
+
+
+############# Planning #################
+
+def best_fit_decreasing(fill: np.ndarray, capacity: np.ndarray) -> np.ndarray:
+    """Packs the contents of the containers into as few containers as possible.\n
+    Containers are taken from the fullest to the emptiest, each one is moved into the container with the least room left
+    that can still hold it, or stays where it is (and can receive others) if there is none.
+
+    Args:
+        fill (np.ndarray): How many units every container holds.
+        capacity (np.ndarray): The max_capacity of every container.
+
+    Returns:
+        np.ndarray: For every container, the index of the container its contents should be moved to, -1 if it stays.
+    """
+    target = np.full(len(fill), -1, dtype=np.int64)
+
+    # empty containers are already free and full ones can neither move nor receive anything
+    candidates = np.flatnonzero((fill > 0) & (fill < capacity))
+    if not len(candidates):
+        return target
+
+    order = candidates[np.argsort(-fill[candidates], kind="stable")]
+
+    # containers that stay, grouped by how much room they have left: bins[n] holds the ones with n units of room,
+    # rooms is the sorted list of the n with a non empty bin (only the room values that occur, max_capacity can be huge)
+    bins = {}
+    rooms = []
+
+    sizes = fill.tolist()
+    capacities = capacity.tolist()
+
+    for i in order.tolist():
+        size = sizes[i]
+
+        # the smallest room that can hold this container
+        position = bisect.bisect_left(rooms, size)
+
+        if position < len(rooms):
+            room = rooms[position]
+            kept = bins[room].pop()
+            if not bins[room]:
+                del bins[room]
+                del rooms[position]
+            target[i] = kept
+            left = room - size
+        else:
+            kept = i
+            left = capacities[i] - size
+
+        if left > 0:
+            if left not in bins:
+                bins[left] = []
+                bisect.insort(rooms, left)
+            bins[left].append(kept)
+
+    return target
+
+
+def _load_fill_levels() -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Returns the ids, capacities, fill levels and shelf ids (None if not on a shelf) of every container."""
+    stmt = (
+        select(
+            Container.container_id,
+            Container.max_capacity,
+            Container.used_capacity,
+            ShelfContainer.shelf_id,
+        )
+        .select_from(Container)
+        .outerjoin(ShelfContainer, ShelfContainer.container_id == Container.container_id)
+    )
+
+    with Session(read_engine()) as session:
+        rows = session.execute(stmt).all()
+
+    if not rows:
+        return (np.array([], dtype=object), np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=object))
+
+    ids, capacities, fills, shelves = zip(*rows)
+    return (
+        np.array(ids, dtype=object),
+        np.array(capacities, dtype=np.int64),
+        np.array(fills, dtype=np.int64),
+        np.array(shelves, dtype=object),
+    )
+
+
+def plan_consolidation() -> dict:
+    """Computes the moves that free the most containers, using the fill level of every container against its max_capacity.
+
+    Returns:
+        dict: A dictionary that looks like the following:\n
+        {
+            "moves": [{"source_container_id": "c51441d2f4cfb275bf28c3b4f3c30afce", "target_container_id": "cf8ddc0c29501413f16c3d5eabeb9a700"}],
+            "freed_containers": 1,           # containers emptied by the moves
+            "empty_containers": 4,           # containers that are already empty
+            "freed_shelf_slots": 1,          # shelved containers emptied by the moves
+            "freed_shelves": ["s4600c099992f81e91b0f1423aa83f7db"],   # shelves holding only empty containers after the moves
+            "zero_quantity_lines": 12,       # product lines stuck at quantity 0, removed when the plan is applied
+            "planning_seconds": 0.8,
+        }
+    """
+    start = time.perf_counter()
+
+    ids, capacity, fill, shelves = _load_fill_levels()
+    target = best_fit_decreasing(fill, capacity)
+
+    sources = np.flatnonzero(target >= 0)
+    moves = [
+        {"source_container_id": source, "target_container_id": destination}
+        for source, destination in zip(ids[sources].tolist(), ids[target[sources]].tolist())
+    ]
+
+    # a shelf is freed when every container on it ends up empty
+    empty = fill == 0
+    freed = (target >= 0) | empty
+    on_shelf = np.flatnonzero(shelves != None)
+    shelf_ids, shelf_codes = np.unique(shelves[on_shelf].astype(str), return_inverse=True)
+    containers_per_shelf = np.bincount(shelf_codes, minlength=len(shelf_ids))
+    freed_per_shelf = np.bincount(shelf_codes, weights=freed[on_shelf], minlength=len(shelf_ids))
+
+    with Session(read_engine()) as session:
+        zero_quantity_lines = session.scalar(select(func.count()).select_from(ContainerContent).where(ContainerContent.quantity == 0))
+
+    return {
+        "moves": moves,
+        "freed_containers": len(moves),
+        "empty_containers": int(empty.sum()),
+        "freed_shelf_slots": int((target[on_shelf] >= 0).sum()),
+        "freed_shelves": shelf_ids[freed_per_shelf == containers_per_shelf].tolist(),
+        "zero_quantity_lines": zero_quantity_lines,
+        "planning_seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+############# Applying #################
+
+def _check_moves(moves: list[dict]):
+    """Raises a ValueError if a container is moved twice, is both moved and receiving products, or does not exist."""
+    sources = [x["source_container_id"] for x in moves]
+    targets = {x["target_container_id"] for x in moves}
+
+    if len(set(sources)) != len(sources):
+        raise ValueError("A container can only be moved once")
+    if targets.intersection(sources):
+        raise ValueError("A container can not be moved and receive products at the same time")
+
+    # on the primary, containers created since the plan may not have reached a replica yet
+    ids = list(targets.union(sources))
+    found = set()
+    with Session(write_engine()) as session:
+        for start in range(0, len(ids), 10_000):
+            found.update(session.scalars(select(Container.container_id).where(Container.container_id.in_(ids[start:start + 10_000]))))
+
+    unknown = sorted(set(ids) - found)
+    if unknown:
+        raise ValueError(f"Containers {', '.join(unknown[:10])}{' and more' if len(unknown) > 10 else ''} do not exist")
+
+
+def _move_contents(session: Session, moves: list[dict]):
+    """Moves every product line of the source containers into their target containers using set based statements.\n
+    Raises a ValueError (and nothing is moved) if a target container would go over its max_capacity,
+    or a shelf over its max_load_capacity.
+    """
+    moves_table = Table(
+        "consolidation_moves", MetaData(),
+        Column("source", String(50), primary_key=True),
+        Column("target", String(50), nullable=False),
+        prefixes=["TEMPORARY"],
+        postgresql_on_commit="DROP",
+    )
+    moves_table.create(session.connection())
+    session.execute(insert(moves_table), [{"source": x["source_container_id"], "target": x["target_container_id"]} for x in moves])
+    moved = select(moves_table.c.source).union(select(moves_table.c.target))
+    lock_containers(session, moved)
+
+    # what every target container receives, per product
+    received = (
+        select(
+            moves_table.c.target.label("container_id"),
+            ContainerContent.product_id,
+            func.sum(ContainerContent.quantity).label("quantity"),
+        )
+        .join(moves_table, moves_table.c.source == ContainerContent.container_id)
+        .group_by(moves_table.c.target, ContainerContent.product_id)
+        .subquery()
+    )
+    returned = (ContainerContent.content_id, ContainerContent.container_id, ContainerContent.product_id, ContainerContent.quantity)
+
+    # products the target already holds
+    stmt = (
+        update(ContainerContent)
+        .where(ContainerContent.container_id == received.c.container_id)
+        .where(ContainerContent.product_id == received.c.product_id)
+        .values(quantity=ContainerContent.quantity + received.c.quantity)
+        .returning(*returned)
+        .execution_options(synchronize_session=False)
+    )
+    changed = session.execute(stmt).all()
+
+    # products the target does not hold yet
+    already_there = exists().where(ContainerContent.container_id == received.c.container_id).where(ContainerContent.product_id == received.c.product_id)
+    stmt = (
+        insert(ContainerContent)
+        .from_select(["container_id", "product_id", "quantity"], select(received.c.container_id, received.c.product_id, received.c.quantity).where(~already_there))
+        .returning(*returned)
+    )
+    changed += session.execute(stmt).all()
+
+    stmt = (
+        delete(ContainerContent)
+        .where(ContainerContent.container_id.in_(select(moves_table.c.source)))
+        .returning(*returned)
+        .execution_options(synchronize_session=False)
+    )
+    removed = session.execute(stmt).all()
+
+    # the contents may have changed since the plan was made
+    over_capacity, over_load = refresh_totals(session, moved)
+    if over_capacity:
+        raise ValueError(f"Containers {', '.join(over_capacity)} would go over their max_capacity")
+    if over_load:
+        raise ValueError(f"Shelves {', '.join(over_load)} would go over their max_load_capacity")
+
+    record_tombstones(session, ContainerContent.__tablename__, [x.content_id for x in removed])
+
+    stmt = select(ShelfContainer.container_id, ShelfContainer.shelf_id).where(ShelfContainer.container_id.in_(moved))
+    shelves = dict(session.execute(stmt).all())
+    publish_changes(session, [
+        {"entity": "container_content", "action": "upsert", "container_id": x.container_id, "product_id": x.product_id, "shelf_id": shelves.get(x.container_id), "quantity": x.quantity}
+        for x in changed
+    ] + [
+        {"entity": "container_content", "action": "delete", "container_id": x.container_id, "product_id": x.product_id, "shelf_id": shelves.get(x.container_id)}
+        for x in removed
+    ])
+
+
+def _delete_zero_quantity_lines(batch_size: int) -> int:
+    """Deletes product lines stuck at quantity 0, a batch per transaction. Returns how many lines were deleted."""
+    deleted = 0
+
+    while True:
+        with Session(write_engine()) as session:
+            batch = select(ContainerContent.content_id).where(ContainerContent.quantity == 0).limit(batch_size)
+            stmt = (
+                delete(ContainerContent)
+                .where(ContainerContent.content_id.in_(batch))
+                .where(ContainerContent.quantity == 0)
+                .returning(ContainerContent.content_id)
+                .execution_options(synchronize_session=False)
+            )
+            removed = session.execute(stmt).scalars().all()
+            record_tombstones(session, ContainerContent.__tablename__, removed)
+            session.commit()
+
+        deleted += len(removed)
+        if len(removed) < batch_size:
+            return deleted
+
+
+def _apply_batch(moves: list[dict]) -> str | None:
+    """Applies moves in a single transaction. Returns why nothing was applied, None if they were."""
+    try:
+        with Session(write_engine()) as session:
+            _move_contents(session, moves)
+            session.commit()
+        return None
+
+    except ValueError as e:
+        return e.args[0]
+    except IntegrityError:
+        # a container was deleted after the moves were checked
+        return "A container of the move does not exist anymore"
+
+
+def apply_consolidation(moves: list[dict], delete_zero_quantity_lines: bool = True, batch_size: int = MOVES_PER_BATCH) -> dict:
+    """Applies the moves of a consolidation plan, MOVES_PER_BATCH moves per transaction.\n
+    A batch that would put a container over its max_capacity (because its contents changed after planning), or a shelf over its
+    max_load_capacity (the plan does not look at weights), is retried move by move, so only the moves that do not fit are skipped.
+
+    Args:
+        moves (list[dict]): The moves returned by plan_consolidation(), they look like the following:\n
+        moves = [
+            {"source_container_id": "c51441d2f4cfb275bf28c3b4f3c30afce", "target_container_id": "cf8ddc0c29501413f16c3d5eabeb9a700"},
+        ]
+        delete_zero_quantity_lines (bool): Also delete product lines stuck at quantity 0.
+        batch_size (int): How many moves are applied per transaction.
+
+    Raises:
+        ValueError: A container is moved twice, is both moved and receiving products, or does not exist. Nothing is applied.
+
+    Returns:
+        dict: Example: {"applied": 120, "skipped": [{"source_container_id": ..., "target_container_id": ..., "reason": ...}], "deleted_zero_quantity_lines": 12}
+    """
+    _check_moves(moves)
+
+    applied = 0
+    skipped = []
+    for start in range(0, len(moves), batch_size):
+        batch = moves[start:start + batch_size]
+
+        reason = _apply_batch(batch)
+        if reason is None:
+            applied += len(batch)
+            continue
+
+        if len(batch) == 1:
+            skipped.append({**batch[0], "reason": reason})
+            continue
+
+        for move in batch:
+            reason = _apply_batch([move])
+            if reason is None:
+                applied += 1
+            else:
+                skipped.append({**move, "reason": reason})
+
+    deleted = _delete_zero_quantity_lines(batch_size) if delete_zero_quantity_lines else 0
+
+    return {"applied": applied, "skipped": skipped, "deleted_zero_quantity_lines": deleted}
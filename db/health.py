@@ -0,0 +1,98 @@
+from db.dbconfig import SCHEMA_VERSION, SchemaVersion, create_schema, site_engines
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy import select, func, text
+import threading
+import time
+import os
+
+# An api process starts serving right away: engines are created on first use, and the schema of every site is
+# checked in the background with a single query (instead of create_all on every boot). The process reports
+# itself ready (GET /health/ready) once every site is reachable and has the schema this code expects.
+
+# What to do with the schema when the api starts:
+#   "create"  create what is missing when the database is behind SCHEMA_VERSION (a single query when it is not)
+#   "check"   only compare the versions, the process is not ready until the database is migrated with `python db/dbconfig.py`
+#   "skip"    trust the database
+SCHEMA_STARTUP = os.environ.get("SCHEMA_STARTUP", "create")
+
+# site -> seconds it took to check (and maybe create) its schema
+_checked: dict[str, float] = {}
+_checked_lock = threading.Lock()
+# time.perf_counter() when every site was ready for the first time
+_ready_at: float | None = None
+
+
+def schema_version(engine) -> int:
+    """Returns the schema version of a database, 0 if it was never versioned."""
+    try:
+        with engine.connect() as connection:
+            return connection.scalar(select(func.coalesce(func.max(SchemaVersion.version), 0)))
+    except ProgrammingError:
+        # the schema_version table does not exist yet
+        return 0
+
+
+def check_schema(site: str):
+    """Makes sure the database of a site has the schema this code expects, only once per process.\n
+    Raises a RuntimeError if it does not and SCHEMA_STARTUP does not allow creating it.
+    """
+    if site in _checked:
+        return
+
+    with _checked_lock:
+        if site in _checked:
+            return
+
+        start = time.perf_counter()
+        engine = site_engines[site]
+        if SCHEMA_STARTUP != "skip":
+            version = schema_version(engine)
+            if version > SCHEMA_VERSION:
+                raise RuntimeError(f"The database of site `{site}` has schema version {version}, newer than the {SCHEMA_VERSION} this code knows")
+            if version < SCHEMA_VERSION:
+                if SCHEMA_STARTUP != "create":
+                    raise RuntimeError(f"The database of site `{site}` has schema version {version}, run `python db/dbconfig.py` to upgrade it to {SCHEMA_VERSION}")
+                create_schema(engine)
+
+        _checked[site] = time.perf_counter() - start
+
+
+def check_every_site() -> dict[str, str | None]:
+    """Checks the schema of every site and pings its primary database.
+
+    Returns:
+        dict[str, str | None]: The error of every site, None for the sites that are ready.
+    """
+    global _ready_at
+
+    errors = {}
+    for site in site_engines:
+        try:
+            check_schema(site)
+            with site_engines[site].connect() as connection:
+                connection.execute(text("SELECT 1"))
+            errors[site] = None
+        except Exception as e:
+            errors[site] = str(e).splitlines()[0]
+
+    if _ready_at is None and not any(errors.values()):
+        _ready_at = time.perf_counter()
+    return errors
+
+
+def startup_times(started_at: float, imported_at: float) -> dict:
+    """Returns how long this process took to start.
+
+    Args:
+        started_at (float): time.perf_counter() when the api started being imported.
+        imported_at (float): time.perf_counter() when the api finished being imported.
+
+    Returns:
+        dict: Example: {"import_seconds": 0.9, "ready_seconds": 1.1, "schema_check_seconds": {"default": 0.004}}
+    """
+    return {
+        "import_seconds": round(imported_at - started_at, 3),
+        # None until every site was ready for the first time
+        "ready_seconds": round(_ready_at - started_at, 3) if _ready_at is not None else None,
+        "schema_check_seconds": {site: round(x, 3) for site, x in _checked.items()},
+    }
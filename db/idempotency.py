@@ -0,0 +1,290 @@
+from db.dbconfig import IdempotencyKey
+from db.routing import current_site, write_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import select, update, delete, func, event
+from contextvars import ContextVar
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import threading
+import logging
+import hashlib
+import json
+import time
+import os
+
+# Scanners retry writes when the Wi-Fi drops, a retry sent with the same Idempotency-Key header gets the response
+# of the first request back instead of writing again. Duplicates arriving while the first request is still running
+# wait for it and share its response. Keys are remembered in memory (the newest MAX_KEYS finished ones, for TTL),
+# and with IDEMPOTENCY_TABLE enabled also in the idempotency_keys table, so every api process knows them.
+# In the table a key is claimed before the write runs, and the claim is kept for TTL by the transaction of the write
+# itself (see _mark_written): once the write committed the key is never run again, even if its response was lost.
+
+# How long a response is kept for retries.
+TTL = timedelta(hours=24)
+
+# How many finished keys every process keeps in memory, the oldest ones are forgotten first.
+MAX_KEYS = 10_000
+
+# How long a duplicate waits for the first request before giving up.
+WAIT_SECONDS = 30.0
+
+# A key claimed in the table by a process that died before its write committed is freed after this long.
+# Keys whose write committed are kept for TTL, a retry gets a KeyInProgressError until their response is stored.
+PENDING_TTL = timedelta(minutes=5)
+
+# How often a duplicate checks the table while another process runs the first request.
+POLL_SECONDS = 0.1
+
+# Share the keys between api processes through the idempotency_keys table.
+IDEMPOTENCY_TABLE = os.environ.get("IDEMPOTENCY_TABLE", "").lower() in ("1", "true", "yes")
+
+
+class KeyReusedError(Exception):
+    """The key was already used for a different request."""
+
+
+class KeyInProgressError(Exception):
+    """The first request with this key did not finish within WAIT_SECONDS."""
+
+
+class _Entry:
+    def __init__(self, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.response = None
+        self.expires_at = float("inf")
+        self.done = threading.Event()
+
+
+class _Claim:
+    def __init__(self, key: str, created_at: datetime):
+        self.key = key
+        # tells this claim apart from a later claim of the same key, after this one was freed
+        self.created_at = created_at
+        # the session whose transaction keeps the claim, until it commits (then written) or rolls back
+        self.marked_by = None
+        self.written = False
+
+
+_entries: OrderedDict[str, _Entry] = OrderedDict()
+_entries_lock = threading.Lock()
+
+# The claim of the write currently running, set by run_once while it runs the write. (None otherwise)
+_current_claim: ContextVar[_Claim | None] = ContextVar("_current_claim", default=None)
+
+
+def _fingerprint(request) -> str:
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _evict(now: float):
+    """Forgets expired keys and the oldest keys beyond MAX_KEYS, must hold _entries_lock.\n
+    Keys of requests that are still running are kept (even beyond MAX_KEYS), a retry must wait for them instead of running again.
+    """
+    excess = len(_entries) - MAX_KEYS
+    evicted = []
+    for scope, entry in _entries.items():
+        if not entry.done.is_set():
+            continue
+        if entry.expires_at > now and excess <= 0:
+            break
+        evicted.append(scope)
+        excess -= 1
+
+    for scope in evicted:
+        del _entries[scope]
+
+
+############# Table #################
+
+def _claim(key: str, fingerprint: str, deadline: float):
+    """Claims a key in the idempotency_keys table.
+
+    Returns:
+        tuple[_Claim | None, object]: (claim, None) if this process claimed the key and must run the request,
+        (None, response) if another process already finished it.
+    """
+    while True:
+        with Session(write_engine()) as session:
+            stmt = (
+                insert(IdempotencyKey)
+                .values(idempotency_key=key, fingerprint=fingerprint, expires_at=func.now() + PENDING_TTL)
+                .on_conflict_do_nothing()
+                .returning(IdempotencyKey.created_at)
+            )
+            created_at = session.execute(stmt).scalar()
+            session.commit()
+            if created_at is not None:
+                return _Claim(key, created_at), None
+
+            stmt = select(
+                IdempotencyKey.fingerprint,
+                IdempotencyKey.response,
+                (IdempotencyKey.expires_at < func.now()).label("expired"),
+            ).where(IdempotencyKey.idempotency_key == key)
+            row = session.execute(stmt).first()
+
+            # expired, or claimed by a process that died before its write committed: free it and try to claim it again
+            if row is not None and row.expired:
+                session.execute(delete(IdempotencyKey).where(IdempotencyKey.idempotency_key == key).where(IdempotencyKey.expires_at < func.now()))
+                session.commit()
+                continue
+
+        if row is None:
+            continue
+        if row.fingerprint != fingerprint:
+            raise KeyReusedError("Idempotency-Key was already used for a different request")
+        if row.response is not None:
+            return None, json.loads(row.response)
+        if time.monotonic() > deadline:
+            raise KeyInProgressError("A request with this Idempotency-Key is still running, retry later")
+        time.sleep(POLL_SECONDS)
+
+
+def _mark_written(session: Session, claim: _Claim):
+    """Keeps the claim for TTL in the transaction of the write, so the key is never freed once the write committed.\n
+    Raises a KeyInProgressError (and the write is rolled back) if the claim was freed in the meantime, another process runs the key now.
+    """
+    stmt = (
+        update(IdempotencyKey)
+        .where(IdempotencyKey.idempotency_key == claim.key)
+        .where(IdempotencyKey.created_at == claim.created_at)
+        .where(IdempotencyKey.response.is_(None))
+        .values(expires_at=func.now() + TTL)
+    )
+    if session.execute(stmt).rowcount != 1:
+        raise KeyInProgressError("A request with this Idempotency-Key is still running, retry later")
+    claim.marked_by = session
+
+
+@event.listens_for(Session, "before_commit")
+def _before_commit(session: Session):
+    claim = _current_claim.get()
+    # only the first transaction of the write on the primary (where the key was claimed) keeps the claim
+    if claim is None or claim.written or claim.marked_by is not None or session.get_bind() is not write_engine():
+        return
+    _mark_written(session, claim)
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session: Session):
+    claim = _current_claim.get()
+    if claim is not None and claim.marked_by is session:
+        claim.written = True
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session: Session):
+    # the commit failed (a flush error for example), the claim is pending again
+    claim = _current_claim.get()
+    if claim is not None and claim.marked_by is session and not claim.written:
+        claim.marked_by = None
+
+
+def _store(claim: _Claim, response):
+    with Session(write_engine()) as session:
+        stmt = (
+            update(IdempotencyKey)
+            .where(IdempotencyKey.idempotency_key == claim.key)
+            .where(IdempotencyKey.created_at == claim.created_at)
+            .values(response=json.dumps(response, default=str), expires_at=func.now() + TTL)
+        )
+        session.execute(stmt)
+
+        # a few expired keys are removed every time, so the table does not grow forever
+        expired = select(IdempotencyKey.idempotency_key).where(IdempotencyKey.expires_at < func.now()).limit(100)
+        session.execute(delete(IdempotencyKey).where(IdempotencyKey.idempotency_key.in_(expired)))
+        session.commit()
+
+
+def _release(claim: _Claim):
+    """Frees a claimed key after the request failed before writing, so a retry runs it again."""
+    with Session(write_engine()) as session:
+        session.execute(
+            delete(IdempotencyKey)
+            .where(IdempotencyKey.idempotency_key == claim.key)
+            .where(IdempotencyKey.created_at == claim.created_at)
+            .where(IdempotencyKey.response.is_(None))
+        )
+        session.commit()
+
+
+############# Running requests #################
+
+def run_once(endpoint: str, key: str, request, function):
+    """Runs a write once per key, retries with the same key get the stored response instead.\n
+    Requests that fail before their write committed are not remembered, a retry runs them again.
+    With IDEMPOTENCY_TABLE the write must commit in a single transaction on the primary of the current site.
+
+    Args:
+        endpoint (str): Keys are only shared by requests to the same endpoint. Example: "POST /container"
+        key (str): The Idempotency-Key header sent by the client.
+        request: Everything the request sent (JSON serializable), reusing a key for a different request raises a KeyReusedError.
+        function: Runs the write and returns a JSON serializable response.
+
+    Returns:
+        tuple[object, bool]: The response and True if it was stored by an earlier request.
+    """
+    fingerprint = _fingerprint(request)
+    scope = f"{current_site.get()} {endpoint} {key}"
+    deadline = time.monotonic() + WAIT_SECONDS
+
+    while True:
+        with _entries_lock:
+            now = time.monotonic()
+            _evict(now)
+            entry = _entries.get(scope)
+            first = entry is None or entry.expires_at <= now
+            if first:
+                entry = _Entry(fingerprint)
+                _entries[scope] = entry
+                _entries.move_to_end(scope)
+
+        if entry.fingerprint != fingerprint:
+            raise KeyReusedError("Idempotency-Key was already used for a different request")
+        if first:
+            break
+
+        # another request with this key is running (or finished) in this process
+        if not entry.done.wait(max(0.0, deadline - time.monotonic())):
+            raise KeyInProgressError("A request with this Idempotency-Key is still running, retry later")
+        if entry.expires_at != float("inf"):
+            return entry.response, True
+        # the first request failed, run it again
+
+    claim = None
+    try:
+        replayed = False
+        if IDEMPOTENCY_TABLE:
+            claim, response = _claim(f"{endpoint} {key}", fingerprint, deadline)
+            replayed = claim is None
+
+        if not replayed:
+            token = _current_claim.set(claim)
+            try:
+                response = function()
+            finally:
+                _current_claim.reset(token)
+
+    except BaseException:
+        with _entries_lock:
+            if _entries.get(scope) is entry:
+                del _entries[scope]
+        entry.done.set()
+        if claim is not None and not claim.written:
+            _release(claim)
+        raise
+
+    entry.response = response
+    entry.expires_at = time.monotonic() + TTL.total_seconds()
+    entry.done.set()
+
+    # the write already happened, a failure here must not fail the request: this process still replays it
+    # and the other processes keep refusing the key (the claim is kept for TTL) instead of running it again
+    if claim is not None:
+        try:
+            _store(claim, response)
+        except Exception:
+            logging.getLogger(__name__).exception(f"Could not store the response of Idempotency-Key {key}")
+
+    return response, replayed
@@ -5,15 +5,31 @@ from db.dbconfig import (
     ShelfContainer,
     ContainerContent,
     ProductIdentifier,
-    engine,
+    Tombstone,
 )
+from db.changefeed import publish_changes
+from db.routing import read_engine, write_engine, run_in_every_site
 from sqlalchemy.orm import Session
 from  sqlalchemy.exc import IntegrityError
 from sqlalchemy import (
+    Table,
+    Column,
+    MetaData,
+    String,
+    Integer,
     func,
     select,
     delete,
     insert,
+    update,
+    exists,
+    and_,
+    or_,
+    case,
+    literal,
+    tuple_,
+    union_all,
+    text,
 )
 import secrets
 import json
@@ -36,17 +52,19 @@ def create_new_shelf(name:str,max_capacity:int) -> str:
     identifier = f"s{secrets.token_hex(16)}"
 
 
-    with Session(engine) as session:
+    with Session(write_engine()) as session:
 
         shelf = Shelf(shelf_id = identifier, shelf_name = name, max_load_capacity = max_capacity, )
         session.add(shelf)
+        publish_changes(session, [{"entity": "shelf", "action": "upsert", "shelf_id": identifier}])
         session.commit()
         
     return identifier
 
 def add_containers_to_shelf(containers:list[dict]):
     """Allows you to add a single or multiple containers to a shelf or shelves. \n
-    NOTe: Duplicate containers in a single shelf are not allowed. A container can only be stored in one shelf at the time.
+    NOTe: Duplicate containers in a single shelf are not allowed. A container can only be stored in one shelf at the time.\n
+    Raises a ValueError if a shelf would go over its max_load_capacity, no container is added then.
 
     Args:
         containers (list[dict]): A list of python dictionaries that look like the following:\n
@@ -65,9 +83,28 @@ def add_containers_to_shelf(containers:list[dict]):
     
     try:
         #https://docs.sqlalchemy.org/en/20/orm/queryguide/dml.html#orm-bulk-insert-statements
-        with Session(engine) as session:
+        with Session(write_engine()) as session:
 
+            # the weight of the containers can not change until they are on their shelves
+            locked = lock_containers(session, [x["container_id"] for x in containers])
             session.execute(insert(ShelfContainer), containers)
+            publish_changes(session, [
+                {"entity": "shelf_container", "action": "upsert", "container_id": x["container_id"], "shelf_id": x["shelf_id"]} for x in containers
+            ])
+
+            # every container reserves its weight on its new shelf
+            session.execute(
+                update(Container)
+                .where(Container.container_id.in_(list(locked)))
+                .values(reserved_load=Container.content_weight)
+                .execution_options(synchronize_session=False)
+            )
+            loads = {}
+            for x in containers:
+                if x["container_id"] in locked:
+                    loads[x["shelf_id"]] = loads.get(x["shelf_id"], 0) + locked[x["container_id"]].content_weight
+            for shelf_id, load in sorted(loads.items()):
+                _adjust_shelf(session, shelf_id, load)
             session.commit()
     except IntegrityError as e:
         e.add_detail("You might be trying to add a container to a shelf that is already aligned to another shelf")
@@ -87,10 +124,28 @@ def unbind_containers_from_shelf(containers:list[str]):
     """
 
     # https://docs.sqlalchemy.org/en/20/orm/queryguide/dml.html#orm-update-and-delete-with-custom-where-criteria
-    with Session(engine) as session:
-
-        stmt = delete(ShelfContainer).where(ShelfContainer.container_id.in_(containers))
-        session.execute(stmt)
+    with Session(write_engine()) as session:
+
+        locked = lock_containers(session, containers)
+        stmt = delete(ShelfContainer).where(ShelfContainer.container_id.in_(containers)).returning(ShelfContainer.shelf_container_id, ShelfContainer.container_id, ShelfContainer.shelf_id)
+        removed = session.execute(stmt).all()
+        record_tombstones(session, ShelfContainer.__tablename__, [x.shelf_container_id for x in removed])
+        publish_changes(session, [
+            {"entity": "shelf_container", "action": "delete", "container_id": x.container_id, "shelf_id": x.shelf_id} for x in removed
+        ])
+
+        # the shelves get back what the containers reserved
+        session.execute(
+            update(Container)
+            .where(Container.container_id.in_([x.container_id for x in removed]))
+            .values(reserved_load=0)
+            .execution_options(synchronize_session=False)
+        )
+        loads = {}
+        for x in removed:
+            loads[x.shelf_id] = loads.get(x.shelf_id, 0) + locked[x.container_id].reserved_load
+        for shelf_id, load in sorted(loads.items()):
+            _adjust_shelf(session, shelf_id, -load)
         session.commit()
 
 
@@ -103,7 +158,7 @@ def inspect_shelf_containers(shelf_id: str) -> list:
     Returns:
         list: A list containing the container_ids inside a specific shelf.
     """
-    with Session(engine) as session:
+    with Session(read_engine()) as session:
         stmt =  select(Shelf).where(Shelf.shelf_id == shelf_id)
         ex = session.execute(statement=stmt)
         results  = ex.scalar_one().shelf_containers
@@ -111,6 +166,66 @@ def inspect_shelf_containers(shelf_id: str) -> list:
         
     return result
 
+def snapshot_shelves(shelf_ids: list[str]) -> list[dict]:
+    """Returns many shelves with their containers and the products inside every container using a single query.\n
+    Useful to audit a whole aisle without inspecting every container one by one.
+
+    Args:
+        shelf_ids (list[str]): A list of shelf ids. Example: ["s4600c099992f81e91b0f1423aa83f7db", "s223cd0ed5e0570b800cc6578b6b451f0"]
+
+    Returns:
+        list[dict]: One dictionary per shelf found, shelves that do not exist are left out. Example:\n
+        [{
+            "shelf_id": "s4600c099992f81e91b0f1423aa83f7db",
+            "shelf_name": "A1",
+            "max_load_capacity": 100,
+            "used_load_capacity": 2.4,
+            "containers": [{
+                "container_id": "cf8ddc0c29501413f16c3d5eabeb9a700",
+                "container_name": "Small tote",
+                "max_capacity": 20,
+                "used_capacity": 4,
+                "content_weight": 2.4,
+                "products": [{"product_id": "pfd3c0433307c5aec6139854829f1b008", "product_name": "Pliers", "quantity": 4}],
+            }],
+        }]
+    """
+    stmt = (
+        select(Shelf.shelf_id, Shelf.shelf_name, Shelf.max_load_capacity, *_container_snapshot_columns())
+        .select_from(Shelf)
+        .outerjoin(ShelfContainer, ShelfContainer.shelf_id == Shelf.shelf_id)
+        .outerjoin(Container, Container.container_id == ShelfContainer.container_id)
+        .outerjoin(ContainerContent, ContainerContent.container_id == Container.container_id)
+        .outerjoin(Product, Product.product_id == ContainerContent.product_id)
+        .where(Shelf.shelf_id.in_(shelf_ids))
+        .order_by(Shelf.shelf_id, Container.container_id, ContainerContent.product_id)
+    )
+
+    with Session(read_engine()) as session:
+        rows = session.execute(stmt).all()
+
+    shelves = {}
+    containers = {}
+    for row in rows:
+        shelf = shelves.get(row.shelf_id)
+        if shelf is None:
+            shelf = shelves[row.shelf_id] = {
+                "shelf_id": row.shelf_id,
+                "shelf_name": row.shelf_name,
+                "max_load_capacity": row.max_load_capacity,
+                # what the containers weigh, Shelf.reserved_load is what they reserved and can be higher
+                "used_load_capacity": 0.0,
+                "containers": [],
+            }
+
+        is_new = row.container_id is not None and row.container_id not in containers
+        container = _add_container_snapshot(containers, row)
+        if is_new:
+            shelf["containers"].append(container)
+            shelf["used_load_capacity"] += container["content_weight"]
+
+    return list(shelves.values())
+
 def delete_shelves(shelf_ids:list[str]):
     """Delete a single or multiple shelves.
 
@@ -124,10 +239,12 @@ def delete_shelves(shelf_ids:list[str]):
         ]
     """
     # https://docs.sqlalchemy.org/en/20/orm/queryguide/dml.html#orm-update-and-delete-with-custom-where-criteria
-    with Session(engine) as session:
+    with Session(write_engine()) as session:
         try:
-            stmt = delete(Shelf).where(Shelf.shelf_id.in_(shelf_ids))
-            session.execute(stmt)
+            stmt = delete(Shelf).where(Shelf.shelf_id.in_(shelf_ids)).returning(Shelf.shelf_id)
+            removed = session.execute(stmt).scalars().all()
+            record_tombstones(session, Shelf.__tablename__, removed)
+            publish_changes(session, [{"entity": "shelf", "action": "delete", "shelf_id": x} for x in removed])
             session.commit()
         except IntegrityError as e:
             e.add_detail(
@@ -152,7 +269,7 @@ def create_new_container(name:str,max_capacity:int, quantity:int) -> str:
     # generates a unique identifier like the following  'c018b311e68b67759b54a08d172f04a09' 
     identifiers = []
 
-    with Session(engine) as session:
+    with Session(write_engine()) as session:
         containers = []
         for i in range(quantity):
 
@@ -161,6 +278,7 @@ def create_new_container(name:str,max_capacity:int, quantity:int) -> str:
             containers.append(Container(container_id = identifier, container_name = name, max_capacity = max_capacity, ))
 
         session.add_all(containers)
+        publish_changes(session, [{"entity": "container", "action": "upsert", "container_id": x} for x in identifiers])
         session.commit()
 
     return identifiers
@@ -173,20 +291,26 @@ def delete_container(container_ids: list[str]):
         container_ids (list): "A list of container ids to be deleted.\n
     """
     
-    with Session(engine) as session:
+    with Session(write_engine()) as session:
         for container_id in container_ids:
             session.query(Container).filter(Container.container_id == container_id).delete()
+        record_tombstones(session, Container.__tablename__, container_ids)
+        publish_changes(session, [{"entity": "container", "action": "delete", "container_id": x} for x in container_ids])
         session.commit()
 
 
 def add_product_to_container(product_id: str, container_id: str, quantity: int):
-    """Adds a single or multiple products to a container.
+    """Adds a single or multiple products to a container.\n
+    Raises a ValueError if the container would go over its max_capacity, or its shelf over its max_load_capacity.
 
     Args:
         product_ids (list[str]): The id of the product to be added to the container. Example: "pfd3c0433307c5aec6139854829f1b008"
         container (str): The id of the container. Example: 'cf8ddc0c29501413f16c3d5eabeb9a700'
     """
-    with Session(engine) as session:
+    with Session(write_engine()) as session:
+        # checks the capacity and locks the container, writes to the same container wait here until the commit
+        _adjust_container(session, container_id, product_id, quantity)
+
         # check if the product is already in the container
 
         stmt =  select(ContainerContent).where(ContainerContent.product_id == product_id ).where(ContainerContent.container_id == container_id )
@@ -197,17 +321,16 @@ def add_product_to_container(product_id: str, container_id: str, quantity: int):
         if result:
             result.quantity += quantity
             q = result.quantity
-            session.commit()
-            return (container_id, product_id, q)
-
 
         # if not, create a new relationship
         else:
             cont  = ContainerContent(container_id=container_id, product_id=product_id, quantity=quantity)
             session.add(cont)   
             q = cont.quantity
-            session.commit()
-            return (container_id, product_id, q)
+
+        _publish_content_change(session, container_id, product_id, q)
+        session.commit()
+        return (container_id, product_id, q)
 
 def remove_product_from_container(product_id: str, container_id: str, quantity: int,):
     """Removes or 'unbinds' a product from a container.
@@ -216,7 +339,10 @@ def remove_product_from_container(product_id: str, container_id: str, quantity:
         product_id (str): The unique identifier of the product.
         quantity (int): The quantity of the product to be removed.
     """
-    with Session(engine) as session:
+    with Session(write_engine()) as session:
+        # locks the container, taking products out always fits and never touches the shelf
+        _adjust_container(session, container_id, product_id, -quantity)
+
         #update row if there is a relationship
         # cont_prod = session.query(ContainerContent).filter(ContainerContent.product_id == product_id).first()
         stmt =  select(ContainerContent).where(ContainerContent.product_id == product_id ).where(ContainerContent.container_id == container_id )
@@ -234,6 +360,7 @@ def remove_product_from_container(product_id: str, container_id: str, quantity:
 
             results.quantity -= quantity
             q = results.quantity
+            _publish_content_change(session, container_id, product_id, q)
             session.commit()
             return (container_id, product_id, q)
         else:
@@ -241,6 +368,22 @@ def remove_product_from_container(product_id: str, container_id: str, quantity:
 
 
 
+def _publish_content_change(session: Session, container_id: str, product_id: str, quantity: int):
+    """Publishes the new quantity of a product inside a container to the change feed.
+
+    The shelf holding the container is included so clients can follow a whole shelf.
+    """
+    shelf_id = session.scalar(select(ShelfContainer.shelf_id).where(ShelfContainer.container_id == container_id))
+    publish_changes(session, [{
+        "entity": "container_content",
+        "action": "upsert",
+        "container_id": container_id,
+        "product_id": product_id,
+        "shelf_id": shelf_id,
+        "quantity": quantity,
+    }])
+
+
 def inspect_container(container_id: str) -> dict:
     """ Returns a list of products inside a container.
 
@@ -250,7 +393,7 @@ def inspect_container(container_id: str) -> dict:
     Returns:
         dict: a dictionary containing the container_id and a list of products inside the container.
     """
-    with  Session(engine) as session:
+    with  Session(read_engine()) as session:
         # container = session.query(Container).filter(Container.container_id ==  container_id).first()
         stmt =  select(ContainerContent).where(ContainerContent.container_id == container_id)
         ex = session.execute(statement=stmt)
@@ -261,6 +404,80 @@ def inspect_container(container_id: str) -> dict:
         return [{"product_id":x.product_id,"quantity": x.quantity} for x in results]
 
 
+def _container_snapshot_columns():
+    """The columns of a container and its contents used by the snapshot queries."""
+    return [
+        Container.container_id,
+        Container.container_name,
+        Container.max_capacity,
+        Container.used_capacity,
+        Container.content_weight,
+        ContainerContent.product_id,
+        Product.product_name,
+        ContainerContent.quantity,
+    ]
+
+
+def _add_container_snapshot(containers: dict, row) -> dict | None:
+    """Adds a row of a snapshot query to a dictionary of containers (by container_id) and returns the container."""
+    if row.container_id is None:
+        return None
+
+    container = containers.get(row.container_id)
+    if container is None:
+        container = containers[row.container_id] = {
+            "container_id": row.container_id,
+            "container_name": row.container_name,
+            "max_capacity": row.max_capacity,
+            "used_capacity": row.used_capacity,
+            "content_weight": row.content_weight,
+            "products": [],
+        }
+
+    if row.product_id is not None:
+        container["products"].append({"product_id": row.product_id, "product_name": row.product_name, "quantity": row.quantity})
+
+    return container
+
+
+def snapshot_containers(container_ids: list[str]) -> list[dict]:
+    """Returns many containers with the products inside them (and their names) using a single query.
+
+    Args:
+        container_ids (list[str]): A list of container ids. Example: ["cf8ddc0c29501413f16c3d5eabeb9a700", "c51441d2f4cfb275bf28c3b4f3c30afce"]
+
+    Returns:
+        list[dict]: One dictionary per container found, containers that do not exist are left out. Example:\n
+        [{
+            "container_id": "cf8ddc0c29501413f16c3d5eabeb9a700",
+            "container_name": "Small tote",
+            "max_capacity": 20,
+            "used_capacity": 4,
+            "content_weight": 2.4,
+            "shelf_id": "s4600c099992f81e91b0f1423aa83f7db",
+            "products": [{"product_id": "pfd3c0433307c5aec6139854829f1b008", "product_name": "Pliers", "quantity": 4}],
+        }]
+    """
+    stmt = (
+        select(*_container_snapshot_columns(), ShelfContainer.shelf_id)
+        .select_from(Container)
+        .outerjoin(ShelfContainer, ShelfContainer.container_id == Container.container_id)
+        .outerjoin(ContainerContent, ContainerContent.container_id == Container.container_id)
+        .outerjoin(Product, Product.product_id == ContainerContent.product_id)
+        .where(Container.container_id.in_(container_ids))
+        .order_by(Container.container_id, ContainerContent.product_id)
+    )
+
+    with Session(read_engine()) as session:
+        rows = session.execute(stmt).all()
+
+    containers = {}
+    for row in rows:
+        _add_container_snapshot(containers, row)["shelf_id"] = row.shelf_id
+
+    return list(containers.values())
+
+
     
     
 
@@ -275,10 +492,366 @@ def inspect_container(container_id: str) -> dict:
 
 
 
+############# Capacity #################
+# Containers and shelves keep running totals of what they hold (Container.used_capacity, Container.content_weight and
+# Shelf.reserved_load). Writes adjust them with a conditional update of a single row that only matches while the
+# limit is respected, so checking max_capacity or max_load_capacity never sums any contents.
+#
+# A shelved container reserves a share of its shelf's max_load_capacity (Container.reserved_load, escrow), and the shelf
+# counts what its containers reserved (Shelf.reserved_load). Reservations run ahead of the weight, so the load a shelf
+# holds is always reported as the sum of the content_weight of its containers instead. Products are added within the
+# reservation by updating the container alone, so picks and receives on the containers of a busy shelf do not queue on the shelf row. Only a container outgrowing its
+# reservation locks the shelf, to reserve twice its new weight (at most once every time its weight doubles). Taking
+# products out never touches the shelf. Reservations a container no longer needs go back to the shelf when it is
+# unbound, when a bulk write recomputes it, or when another container of a full shelf needs them.
+# Containers are always locked before shelves.
+
+# A container outgrowing its reservation reserves this many times its new weight, so it does not come back soon.
+RESERVE_FACTOR = 2.0
+
+
+def _adjust_container(session: Session, container_id: str, product_id: str, quantity: int):
+    """Adds `quantity` units of a product to the totals of a container (negative to take them out) and locks the container.\n
+    Raises a ValueError if the container or the product does not exist, if the container would go over its max_capacity,
+    or if its shelf can not make room for the weight beyond its reservation.
+    """
+    unit = select(Product.unit_size, Product.unit_weight).where(Product.product_id == product_id).subquery()
+    size = unit.c.unit_size * quantity
+    weight = unit.c.unit_weight * quantity
+    stmt = (
+        update(Container)
+        .where(Container.container_id == container_id)
+        .where(or_(size <= 0, Container.used_capacity + size <= Container.max_capacity))
+        .values(used_capacity=Container.used_capacity + size, content_weight=Container.content_weight + weight)
+        .returning(Container.content_weight, Container.reserved_load)
+        .execution_options(synchronize_session=False)
+    )
+    adjusted = session.execute(stmt).first()
+    if adjusted is not None:
+        if adjusted.content_weight > adjusted.reserved_load:
+            _reserve_load(session, container_id, adjusted.content_weight, adjusted.reserved_load)
+        return
+
+    container = session.execute(select(Container.used_capacity, Container.max_capacity).where(Container.container_id == container_id)).first()
+    unit_size = session.scalar(select(Product.unit_size).where(Product.product_id == product_id))
+    if container is None:
+        raise ValueError(f"Container {container_id} not found")
+    if unit_size is None:
+        raise ValueError(f"Product {product_id} not found")
+    raise ValueError(
+        f"Container {container_id} does not have room for {quantity} units of product {product_id}: "
+        f"they need {quantity * unit_size} and only {container.max_capacity - container.used_capacity} of its max_capacity ({container.max_capacity}) is left"
+    )
+
+
+def _reserve_load(session: Session, container_id: str, content_weight: float, reserved_load: float):
+    """Reserves more of its shelf's load for a (locked) container that outgrew its reservation.\n
+    Raises a ValueError if the shelf can not make room for its weight. Containers that are not on a shelf reserve nothing.
+    """
+    shelf_id = session.scalar(select(ShelfContainer.shelf_id).where(ShelfContainer.container_id == container_id))
+    if shelf_id is None:
+        return
+
+    shelf = session.execute(select(Shelf.reserved_load, Shelf.max_load_capacity).where(Shelf.shelf_id == shelf_id).with_for_update()).first()
+    needed = content_weight - reserved_load
+    room = shelf.max_load_capacity - shelf.reserved_load
+    released = _release_idle_reservations(session, shelf_id) if room < needed else 0
+    room += released
+    if room < needed:
+        raise ValueError(f"Shelf {shelf_id} would go over its max_load_capacity with {needed} more weight")
+
+    granted = min(max(content_weight * RESERVE_FACTOR - reserved_load, needed), room)
+    session.execute(
+        update(Shelf)
+        .where(Shelf.shelf_id == shelf_id)
+        .values(reserved_load=Shelf.reserved_load + granted - released)
+        .execution_options(synchronize_session=False)
+    )
+    session.execute(
+        update(Container)
+        .where(Container.container_id == container_id)
+        .values(reserved_load=Container.reserved_load + granted)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _release_idle_reservations(session: Session, shelf_id: str) -> float:
+    """Shrinks the reservations of the containers of a (locked) shelf to their weight, and returns how much was released.\n
+    Containers locked by other writes are skipped instead of waited for. The caller takes the released load off the shelf.
+    """
+    stmt = (
+        select(Container.container_id, (Container.reserved_load - Container.content_weight).label("unused"))
+        .join(ShelfContainer, ShelfContainer.container_id == Container.container_id)
+        .where(ShelfContainer.shelf_id == shelf_id)
+        .where(Container.reserved_load > Container.content_weight)
+        .with_for_update(of=Container, skip_locked=True)
+    )
+    idle = session.execute(stmt).all()
+    if not idle:
+        return 0
+
+    session.execute(
+        update(Container)
+        .where(Container.container_id.in_([x.container_id for x in idle]))
+        .values(reserved_load=Container.content_weight)
+        .execution_options(synchronize_session=False)
+    )
+    return sum(x.unused for x in idle)
+
+
+def _add_shelf_load(session: Session, shelf_id: str, load: float) -> bool:
+    """Adds load to a shelf (negative to take it off), returns False if it would go over its max_load_capacity."""
+    stmt = (
+        update(Shelf)
+        .where(Shelf.shelf_id == shelf_id)
+        .values(reserved_load=Shelf.reserved_load + load)
+        .returning(Shelf.shelf_id)
+        .execution_options(synchronize_session=False)
+    )
+    if load > 0:
+        stmt = stmt.where(Shelf.reserved_load + load <= Shelf.max_load_capacity)
+    return session.execute(stmt).first() is not None
+
+
+def _adjust_shelf(session: Session, shelf_id: str | None, load: float):
+    """Adds load to a shelf (negative to take it off).\n
+    Raises a ValueError if the shelf would go over its max_load_capacity, even after releasing the reservations its
+    containers do not need. Taking load off is always allowed.
+    """
+    if shelf_id is None or not load:
+        return
+    if _add_shelf_load(session, shelf_id, load):
+        return
+
+    # released reservations come back when the shelf still can not take the load, the transaction is rolled back
+    released = _release_idle_reservations(session, shelf_id) if load > 0 else 0
+    if not released or not _add_shelf_load(session, shelf_id, load - released):
+        raise ValueError(f"Shelf {shelf_id} would go over its max_load_capacity with {load} more weight")
+
+
+def lock_containers(session: Session, container_ids) -> dict:
+    """Locks containers until the commit, in a fixed order so concurrent writes can not deadlock.\n
+    Writes touching the contents of many containers lock them first, the same as single writes do.
+
+    Args:
+        container_ids: A list of container ids or a select returning them.
+
+    Returns:
+        dict: The content_weight and reserved_load of every container found, by container_id.
+    """
+    stmt = (
+        select(Container.container_id, Container.content_weight, Container.reserved_load)
+        .where(Container.container_id.in_(container_ids))
+        .order_by(Container.container_id)
+        .with_for_update()
+    )
+    return {x.container_id: x for x in session.execute(stmt).all()}
+
+
+def refresh_totals(session: Session, container_ids) -> tuple[list[str], list[str]]:
+    """Recomputes the totals of some containers from their contents, and sets the reservation of the shelved ones to their weight.\n
+    Used by the writes that change many product lines at once, only the given containers are summed.
+    Call lock_containers() before changing their contents.
+
+    Args:
+        container_ids: A list of container ids or a select returning them.
+
+    Returns:
+        tuple[list[str], list[str]]: The containers over their max_capacity and the shelves that got heavier and are over their max_load_capacity.
+    """
+    before = lock_containers(session, container_ids)
+    if not before:
+        return [], []
+
+    stmt = select(ShelfContainer.container_id, ShelfContainer.shelf_id).where(ShelfContainer.container_id.in_(list(before)))
+    shelves = dict(session.execute(stmt).all())
+
+    totals = (
+        select(
+            Container.container_id,
+            func.coalesce(func.sum(ContainerContent.quantity * Product.unit_size), 0).label("used_capacity"),
+            func.coalesce(func.sum(ContainerContent.quantity * Product.unit_weight), 0).label("content_weight"),
+        )
+        .select_from(Container)
+        .outerjoin(ContainerContent, ContainerContent.container_id == Container.container_id)
+        .outerjoin(Product, Product.product_id == ContainerContent.product_id)
+        .where(Container.container_id.in_(list(before)))
+        .group_by(Container.container_id)
+        .subquery()
+    )
+    shelved = Container.container_id.in_(list(shelves))
+    stmt = (
+        update(Container)
+        .where(Container.container_id == totals.c.container_id)
+        .values(
+            used_capacity=totals.c.used_capacity,
+            content_weight=totals.c.content_weight,
+            reserved_load=case((shelved, totals.c.content_weight), else_=0),
+        )
+        .returning(Container.container_id, Container.used_capacity, Container.max_capacity, Container.reserved_load)
+        .execution_options(synchronize_session=False)
+    )
+    containers = session.execute(stmt).all()
+
+    loads = {}
+    for x in containers:
+        if x.container_id in shelves:
+            loads[shelves[x.container_id]] = loads.get(shelves[x.container_id], 0) + x.reserved_load - before[x.container_id].reserved_load
+
+    def add_load(shelf_id: str, load: float) -> bool:
+        stmt = (
+            update(Shelf)
+            .where(Shelf.shelf_id == shelf_id)
+            .values(reserved_load=Shelf.reserved_load + load)
+            .returning(Shelf.reserved_load > Shelf.max_load_capacity)
+            .execution_options(synchronize_session=False)
+        )
+        return session.scalar(stmt)
+
+    over_load = []
+    for shelf_id, load in sorted(loads.items()):
+        if not load:
+            continue
+        # a shelf may only be over by what its other containers reserved beyond their weight, they give it back first
+        if add_load(shelf_id, load) and load > 0 and add_load(shelf_id, -_release_idle_reservations(session, shelf_id)):
+            over_load.append(shelf_id)
+
+    return [x.container_id for x in containers if x.used_capacity > x.max_capacity], over_load
+
+
+############# Cycle counts #################
+
+def reconcile_cycle_count(lines: list[dict], apply: bool = False) -> dict:
+    """Compares a count sheet with the stored quantities of the counted containers.\n
+    Every counted container is considered fully counted, stored products missing from the sheet were counted as 0.
+    The count sheet is loaded into a temporary table and compared with a single set based query.
+
+    Args:
+        lines (list[dict]): The count sheet, a list of python dictionaries that look like the following:\n
+        lines = [
+            {"container_id": "cf8ddc0c29501413f16c3d5eabeb9a700", "product_id": "pfd3c0433307c5aec6139854829f1b008", "quantity": 4},
+            {"container_id": "cf8ddc0c29501413f16c3d5eabeb9a700", "product_id": "p890e865336129d669c9a96d12cd2b9d6", "quantity": 0},
+        ]
+        apply (bool): Also correct the stored quantities to the counted ones. (All or nothing)
+
+    Returns:
+        dict: Example:\n
+        {
+            "containers": 1,
+            "lines": 2,
+            "discrepancies": [{"container_id": "cf8ddc0c29501413f16c3d5eabeb9a700", "product_id": "pfd3c0433307c5aec6139854829f1b008", "expected": 6, "counted": 4, "difference": -2}],
+            "applied": False,
+        }
+    """
+    count_sheet = Table(
+        "count_sheet", MetaData(),
+        Column("container_id", String(50), nullable=False),
+        Column("product_id", String(50), nullable=False),
+        Column("quantity", Integer, nullable=False),
+        prefixes=["TEMPORARY"],
+        postgresql_on_commit="DROP",
+    )
+    counted_containers = select(count_sheet.c.container_id).distinct()
+
+    with Session(write_engine()) as session:
+        count_sheet.create(session.connection())
+        if lines:
+            session.execute(insert(count_sheet), lines)
+
+        # nobody can change the counted containers until the corrections are committed
+        if apply:
+            lock_containers(session, counted_containers)
+            session.execute(select(ContainerContent.content_id).where(ContainerContent.container_id.in_(counted_containers)).with_for_update())
+
+        stored = (
+            select(ContainerContent.container_id, ContainerContent.product_id, func.sum(ContainerContent.quantity).label("quantity"))
+            .where(ContainerContent.container_id.in_(counted_containers))
+            .group_by(ContainerContent.container_id, ContainerContent.product_id)
+            .subquery("stored")
+        )
+        counted = (
+            select(count_sheet.c.container_id, count_sheet.c.product_id, func.sum(count_sheet.c.quantity).label("quantity"))
+            .group_by(count_sheet.c.container_id, count_sheet.c.product_id)
+            .subquery("counted")
+        )
+        expected = func.coalesce(stored.c.quantity, 0)
+        found = func.coalesce(counted.c.quantity, 0)
+        stmt = (
+            select(
+                func.coalesce(stored.c.container_id, counted.c.container_id).label("container_id"),
+                func.coalesce(stored.c.product_id, counted.c.product_id).label("product_id"),
+                expected.label("expected"),
+                found.label("counted"),
+            )
+            .select_from(stored.join(counted, and_(stored.c.container_id == counted.c.container_id, stored.c.product_id == counted.c.product_id), full=True))
+            .where(expected != found)
+            .order_by("container_id", "product_id")
+        )
+        discrepancies = session.execute(stmt).all()
+        containers = session.scalar(select(func.count()).select_from(counted_containers.subquery()))
+
+        if apply and discrepancies:
+            counted_quantity = (
+                select(func.sum(count_sheet.c.quantity))
+                .where(count_sheet.c.container_id == ContainerContent.container_id)
+                .where(count_sheet.c.product_id == ContainerContent.product_id)
+                .scalar_subquery()
+            )
+            returned = (ContainerContent.container_id, ContainerContent.product_id, ContainerContent.quantity)
+
+            # stored lines, set to what was counted (0 if missing from the sheet)
+            stmt = (
+                update(ContainerContent)
+                .where(ContainerContent.container_id.in_(counted_containers))
+                .where(ContainerContent.quantity != func.coalesce(counted_quantity, 0))
+                .values(quantity=func.coalesce(counted_quantity, 0))
+                .returning(*returned)
+                .execution_options(synchronize_session=False)
+            )
+            changed = session.execute(stmt).all()
+
+            # counted products the container did not have
+            already_there = exists().where(ContainerContent.container_id == counted.c.container_id).where(ContainerContent.product_id == counted.c.product_id)
+            stmt = (
+                insert(ContainerContent)
+                .from_select(["container_id", "product_id", "quantity"], select(counted.c.container_id, counted.c.product_id, counted.c.quantity).where(counted.c.quantity > 0).where(~already_there))
+                .returning(*returned)
+            )
+            try:
+                changed += session.execute(stmt).all()
+            except IntegrityError as e:
+                e.add_detail("You might be trying to count a product or container that does not exist")
+                raise e
+
+            # a count is what is physically there, it is applied even if it goes over max_capacity or max_load_capacity
+            refresh_totals(session, counted_containers)
+
+            stmt = select(ShelfContainer.container_id, ShelfContainer.shelf_id).where(ShelfContainer.container_id.in_(counted_containers))
+            shelves = dict(session.execute(stmt).all())
+            publish_changes(session, [
+                {"entity": "container_content", "action": "upsert", "container_id": x.container_id, "product_id": x.product_id, "shelf_id": shelves.get(x.container_id), "quantity": x.quantity}
+                for x in changed
+            ])
+
+        session.commit()
+
+    return {
+        "containers": containers,
+        "lines": len(lines),
+        "discrepancies": [
+            {"container_id": x.container_id, "product_id": x.product_id, "expected": x.expected, "counted": x.counted, "difference": x.counted - x.expected}
+            for x in discrepancies
+        ],
+        "applied": apply,
+    }
+
+
+
+
 ############# Products #################
 #nOTE create functin that modifies additional_product_ids from a product
 
-def create_new_product(name:str, description:str, additional_product_ids: None | list[dict] = None ) -> str:
+def create_new_product(name:str, description:str, additional_product_ids: None | list[dict] = None, unit_size: int = 1, unit_weight: float = 0) -> str:
     """Creates a new product.
 
     Args:
@@ -291,6 +864,8 @@ def create_new_product(name:str, description:str, additional_product_ids: None |
             {"identifier_type":"ASIN", "identifier_value":"B01NBKTPTS"},
             {"identifier_type":"GTIN", "identifier_value":"00853084004477"},
         ]      
+        unit_size (int): How much of a container's max_capacity a single unit takes.
+        unit_weight (float): How much a single unit weighs, in the same unit as a shelf's max_load_capacity.
 
     Returns:
         str: The unique identifier created for this product.
@@ -306,11 +881,11 @@ def create_new_product(name:str, description:str, additional_product_ids: None |
             id = ProductIdentifier(identifier_type= i["identifier_type"], identifier_value= i["identifier_value"] )
             ids.append(id)
 
-        with Session(engine) as session:
+        with Session(write_engine()) as session:
 
             try:
 
-                container = Product(product_id=identifier, product_name=name, description=description, additional_identifiers=ids)
+                container = Product(product_id=identifier, product_name=name, description=description, unit_size=unit_size, unit_weight=unit_weight, additional_identifiers=ids)
                 session.add(container)
                 session.commit()
             
@@ -321,10 +896,10 @@ def create_new_product(name:str, description:str, additional_product_ids: None |
                 raise e
 
     else:
-        with Session(engine) as session:
+        with Session(write_engine()) as session:
             try:
                 
-                container = Product(product_id=identifier, product_name=name, description=description)
+                container = Product(product_id=identifier, product_name=name, description=description, unit_size=unit_size, unit_weight=unit_weight)
                 session.add(container)
                 session.commit()
 
@@ -350,6 +925,8 @@ def convert_product_object_to_dict(product_object:Product) -> str:
         'name': product_object.product_name,
         'description': product_object.description,
         'product_id': product_object.product_id,
+        'unit_size': product_object.unit_size,
+        'unit_weight': product_object.unit_weight,
         # this line basically creates a list of dicts if our object has additional ids in it, if not, it returns an empty list.
         # 'additional_ids': list(map(lambda add_id: {"identifier_type":add_id.identifier_type,"value":add_id.identifier_value},product.additional_identifiers)),
         'additional_ids': [{"identifier_type":x.identifier_type, "identifier_value":x.identifier_value} for x in product_object.additional_identifiers],
@@ -370,7 +947,7 @@ def search_product_by_product_id(product_id:str)-> list[dict] | None:
         list[dict]None: A list of products found
     """
 
-    with Session(engine) as session:
+    with Session(read_engine()) as session:
 
         results = session.query(Product).filter(
             (Product.product_id == product_id) |  # Exact match
@@ -393,7 +970,7 @@ def search_product_by_name(product_name:str)-> list[dict] | None:
         list[dict]None: A list of products found
     """
 
-    with Session(engine) as session:
+    with Session(read_engine()) as session:
 
         # sqlalchemy.func
         results = session.query(Product).filter(
@@ -409,6 +986,28 @@ def search_product_by_name(product_name:str)-> list[dict] | None:
 
 
 
+def search_product_in_every_site(search: str) -> dict:
+    """Searches for a product by name or product_id in every site at the same time.\n
+    Sites that fail or are too slow (see SITE_TIMEOUT_SECONDS in db/routing.py) are left out and listed in "failed_sites".
+
+    Args:
+        search (str): Example: "Pliers" or "pe376df18d1ce5dbbcb74d0c492a872be"
+
+    Returns:
+        dict: The products found, every product has a "site" key with the site it belongs to.
+            Example: {"products": [{"name": "Pliers", ..., "site": "east"}], "failed_sites": {"west": "Did not answer within 5.0 seconds"}}
+    """
+    def search_site():
+        return search_product_by_name(search) + search_product_by_product_id(search)
+
+    results, failed_sites = run_in_every_site(search_site)
+    matches = []
+    for site, products in results.items():
+        matches.extend({**product, "site": site} for product in products)
+
+    return {"products": matches, "failed_sites": failed_sites}
+
+
 def delete_product_by_identifier(products:list[str])-> str | None:
     """Deletes a single  or multiple products from the db.
 
@@ -418,7 +1017,132 @@ def delete_product_by_identifier(products:list[str])-> str | None:
     Returns:
         str: A list of pro
     """
-    with Session(engine) as session:
-        stmt = delete(Product).where(Product.product_id.in_(products))
-        session.execute(stmt)
-        session.commit()
\ No newline at end of file
+    with Session(write_engine()) as session:
+        stmt = delete(Product).where(Product.product_id.in_(products)).returning(Product.product_id)
+        removed = session.execute(stmt).scalars().all()
+        record_tombstones(session, Product.__tablename__, removed)
+        session.commit()
+
+
+
+############# Sync #################
+
+def record_tombstones(session: Session, entity: str, entity_ids: list):
+    """Remembers deleted rows so devices doing a delta sync can delete them too.
+
+    Args:
+        entity (str): The __tablename__ of the deleted rows.
+        entity_ids (list): The primary keys of the deleted rows.
+    """
+    if entity_ids:
+        session.execute(insert(Tombstone), [{"entity": entity, "entity_id": str(x)} for x in entity_ids])
+
+
+# The columns sent for every synced table, rows are sent as lists (in this order) to keep pages small.
+# The load of a shelf is the sum of the content_weight of the containers on it.
+SYNC_COLUMNS = {
+    Product.__tablename__: ["product_id", "product_name", "description", "additional_ids", "unit_size", "unit_weight", "updated_at"],
+    Container.__tablename__: ["container_id", "container_name", "max_capacity", "used_capacity", "content_weight", "updated_at"],
+    ContainerContent.__tablename__: ["content_id", "container_id", "product_id", "quantity"],
+    Shelf.__tablename__: ["shelf_id", "shelf_name", "max_load_capacity"],
+    ShelfContainer.__tablename__: ["shelf_container_id", "shelf_id", "container_id"],
+}
+
+
+def _parse_sync_cursor(cursor: str | None) -> tuple[int, int]:
+    """Turns a cursor like '1234-56' into (transaction id, change sequence number)."""
+    if not cursor:
+        return (0, 0)
+    try:
+        xid, seq = cursor.split("-")
+        return (int(xid), int(seq))
+    except ValueError:
+        raise ValueError(f"Invalid sync cursor `{cursor}`")
+
+
+def sync_changes(cursor: str | None = None, limit: int = 1000) -> dict:
+    """Returns the rows that changed (or were deleted) since the given cursor, oldest first.
+
+    Start without a cursor to download everything, then keep passing the returned cursor until has_more is False.
+
+    Args:
+        cursor (str | None): The cursor returned by the previous call. Example: "1234-56"
+        limit (int): Maximum number of changed rows to return.
+
+    Returns:
+        dict: A dictionary that looks like the following:
+
+        {
+            "cursor": "1290-77",
+            "has_more": False,
+            "columns": {"containers": ["container_id", "container_name", "max_capacity", "used_capacity", "content_weight", "updated_at"], ...},
+            "changes": {"containers": [["cf8ddc0c29501413f16c3d5eabeb9a700", "Tote", 20, 4, 2.4, "2025-01-08T03:43:33.850485"]], ...},
+            "deleted": {"shelf_containers": ["12"], ...},
+        }
+    """
+    after = _parse_sync_cursor(cursor)
+
+    identifiers = (
+        select(func.coalesce(func.json_agg(func.json_build_object(
+            "identifier_type", ProductIdentifier.identifier_type,
+            "identifier_value", ProductIdentifier.identifier_value,
+        )), text("'[]'::json")))
+        .where(ProductIdentifier.product_id == Product.product_id)
+        .scalar_subquery()
+    )
+    rows = {
+        Product: [Product.product_id, Product.product_name, Product.description, identifiers, Product.unit_size, Product.unit_weight, Product.updated_at],
+        Container: [Container.container_id, Container.container_name, Container.max_capacity, Container.used_capacity, Container.content_weight, Container.updated_at],
+        ContainerContent: [ContainerContent.content_id, ContainerContent.container_id, ContainerContent.product_id, ContainerContent.quantity],
+        Shelf: [Shelf.shelf_id, Shelf.shelf_name, Shelf.max_load_capacity],
+        ShelfContainer: [ShelfContainer.shelf_container_id, ShelfContainer.shelf_id, ShelfContainer.container_id],
+        Tombstone: [Tombstone.entity, Tombstone.entity_id],
+    }
+
+    with Session(read_engine()) as session:
+        # every transaction older than this one has finished, so no change before it can still show up
+        horizon = session.scalar(text("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint"))
+
+        # each table walks its (change_xid, change_seq) index and stops after `limit` rows
+        pages = []
+        for model, columns in rows.items():
+            pages.append(
+                select(
+                    model.change_xid.label("xid"),
+                    model.change_seq.label("seq"),
+                    literal(model.__tablename__).label("entity"),
+                    func.json_build_array(*columns).label("row"),
+                )
+                .where(tuple_(model.change_xid, model.change_seq) > tuple_(*after))
+                .where(model.change_xid < horizon)
+                .order_by(model.change_xid, model.change_seq)
+                .limit(limit + 1)
+                .subquery()
+                .select()
+            )
+
+        merged = union_all(*pages).subquery()
+        stmt = select(merged).order_by(merged.c.xid, merged.c.seq).limit(limit + 1)
+        results = session.execute(stmt).all()
+
+    has_more = len(results) > limit
+    results = results[:limit]
+
+    changes = {}
+    deleted = {}
+    for x in results:
+        if x.entity == Tombstone.__tablename__:
+            entity, entity_id = x.row
+            deleted.setdefault(entity, []).append(entity_id)
+        else:
+            changes.setdefault(x.entity, []).append(x.row)
+
+    last = (results[-1].xid, results[-1].seq) if results else after
+
+    return {
+        "cursor": f"{last[0]}-{last[1]}",
+        "has_more": has_more,
+        "columns": SYNC_COLUMNS,
+        "changes": changes,
+        "deleted": deleted,
+    }
@@ -0,0 +1,219 @@
+from sqlalchemy import Engine, event
+from contextvars import ContextVar
+from collections import OrderedDict
+from datetime import datetime, timezone
+import functools
+import cProfile
+import pstats
+import secrets
+import threading
+import random
+import json
+import time
+import os
+
+# A profiled request records a CPU profile (cProfile) and every SQL statement it runs with how long it took.
+# Requests are profiled when they send the PROFILE_HEADER with the PROFILE_TOKEN, or at random with a chance of PROFILE_SAMPLE_RATE.
+# Profiles are kept in PROFILE_DIR (the newest MAX_PROFILES of them) and served by the api:
+#   <profile_id>.prof   cProfile stats, open them with `python -m pstats` or snakeviz
+#   <profile_id>.json   the request, its SQL statements and the functions that took the longest
+
+# Header asking for the request to be profiled, its value must be the PROFILE_TOKEN. Example: "X-Profile: 3f9a..."
+# The same header gives access to the saved profiles, they hold the SQL statements of other clients.
+PROFILE_HEADER = "X-Profile"
+
+# Secret allowing clients to profile requests and read profiles, without it only sampling (PROFILE_SAMPLE_RATE) works.
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+
+# Share of the requests profiled without asking, between 0 and 1.
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+
+# Where the profiles are saved.
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/chaotic-storage-profiles")
+
+# How many profiles are kept, the oldest ones are deleted first.
+MAX_PROFILES = int(os.environ.get("MAX_PROFILES", "200"))
+
+# How many functions are listed in the summary of a profile.
+TOP_FUNCTIONS = 30
+
+# The profile of the current request. (None when the request is not profiled)
+current_profile: ContextVar["RequestProfile | None"] = ContextVar("current_profile", default=None)
+
+_saved: OrderedDict[str, dict] = OrderedDict()
+_saved_lock = threading.Lock()
+
+# The profile currently recording the event loop thread, only one request at a time can.
+_event_loop_profile: "RequestProfile | None" = None
+
+
+class RequestProfile:
+    """Everything recorded while serving a single request."""
+
+    def __init__(self, method: str, path: str):
+        self.profile_id = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{secrets.token_hex(4)}"
+        self.method = method
+        self.path = path
+        self.started_at = datetime.now(timezone.utc)
+        self.statements = []
+        # one profiler per thread that worked on the request, cProfile can only follow the thread it was enabled in
+        self.profilers = []
+        self._lock = threading.Lock()
+
+    def profiler(self) -> cProfile.Profile:
+        profiler = cProfile.Profile()
+        with self._lock:
+            self.profilers.append(profiler)
+        return profiler
+
+    def add_statement(self, statement: str, seconds: float, rows: int):
+        with self._lock:
+            self.statements.append({"statement": statement, "ms": round(seconds * 1000, 3), "rows": rows})
+
+
+def has_profile_token(headers) -> bool:
+    """Returns True if the request sent the PROFILE_TOKEN in the PROFILE_HEADER, always False when no token is configured."""
+    return bool(PROFILE_TOKEN) and secrets.compare_digest(headers.get(PROFILE_HEADER, "").encode(), PROFILE_TOKEN.encode())
+
+
+def should_profile(headers) -> bool:
+    """Decides if a request is profiled, from its headers and PROFILE_SAMPLE_RATE."""
+    if has_profile_token(headers):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def profiled(function):
+    """Decorator recording the CPU profile of a function in the thread it runs in, when the current request is profiled."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        profile = current_profile.get()
+        if profile is None:
+            return function(*args, **kwargs)
+        return profile.profiler().runcall(function, *args, **kwargs)
+
+    return wrapper
+
+
+def start_event_loop_profiler(profile: RequestProfile) -> cProfile.Profile | None:
+    """Starts recording the event loop thread (request parsing, validation and serialization) for a profiled request.\n
+    The event loop serves other requests at the same time, their work shows up in this profile too.
+    Returns None if another request is already recording the event loop.
+    """
+    global _event_loop_profile
+
+    if _event_loop_profile is not None:
+        return None
+    _event_loop_profile = profile
+    profiler = profile.profiler()
+    profiler.enable()
+    return profiler
+
+
+def stop_event_loop_profiler(profiler: cProfile.Profile):
+    global _event_loop_profile
+
+    profiler.disable()
+    _event_loop_profile = None
+
+
+############# SQL statements #################
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_profile.get() is not None:
+        conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile.get()
+    started = conn.info.get("profile_started")
+    if profile is None or not started:
+        return
+    # parameters are left out on purpose, they may hold customer data
+    profile.add_statement(statement, time.perf_counter() - started.pop(), cursor.rowcount)
+
+
+############# Artifacts #################
+
+def _pool_wait(stats: pstats.Stats) -> float:
+    """Seconds spent waiting for a connection from the pool, taken from the profile."""
+    return sum(
+        x[3] for (filename, _, function), x in stats.stats.items()
+        if function == "_do_get" and filename.endswith(os.path.join("pool", "impl.py"))
+    )
+
+
+def _top_functions(stats: pstats.Stats) -> list[dict]:
+    rows = sorted(stats.stats.items(), key=lambda x: x[1][3], reverse=True)[:TOP_FUNCTIONS]
+    return [
+        {"function": f"{filename}:{line}({function})", "calls": x[1], "own_ms": round(x[2] * 1000, 3), "cumulative_ms": round(x[3] * 1000, 3)}
+        for (filename, line, function), x in rows
+    ]
+
+
+def save_profile(profile: RequestProfile, status_code: int, seconds: float) -> dict:
+    """Saves the profile of a finished request in PROFILE_DIR and forgets the oldest profiles beyond MAX_PROFILES.
+
+    Returns:
+        dict: The summary of the profile, the same as get_profile().
+    """
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+
+    profilers = [x for x in profile.profilers if x.getstats()]
+    stats = pstats.Stats(*profilers) if profilers else None
+    if stats:
+        stats.dump_stats(os.path.join(PROFILE_DIR, f"{profile.profile_id}.prof"))
+
+    summary = {
+        "profile_id": profile.profile_id,
+        "method": profile.method,
+        "path": profile.path,
+        "status_code": status_code,
+        "started_at": profile.started_at.isoformat(),
+        "ms": round(seconds * 1000, 3),
+        "sql_ms": round(sum(x["ms"] for x in profile.statements), 3),
+        "sql_statements": len(profile.statements),
+        "pool_wait_ms": round(_pool_wait(stats) * 1000, 3) if stats else 0,
+        "has_pstats": stats is not None,
+        "statements": profile.statements,
+        "top_functions": _top_functions(stats) if stats else [],
+    }
+    with open(os.path.join(PROFILE_DIR, f"{profile.profile_id}.json"), "w") as f:
+        json.dump(summary, f, indent=4)
+
+    with _saved_lock:
+        _saved[profile.profile_id] = {x: summary[x] for x in ("profile_id", "method", "path", "status_code", "started_at", "ms", "sql_ms", "sql_statements")}
+        while len(_saved) > MAX_PROFILES:
+            oldest, _ = _saved.popitem(last=False)
+            for extension in ("prof", "json"):
+                try:
+                    os.remove(os.path.join(PROFILE_DIR, f"{oldest}.{extension}"))
+                except FileNotFoundError:
+                    pass
+
+    return summary
+
+
+def list_profiles() -> list[dict]:
+    """Returns the profiles kept by this process, newest first."""
+    with _saved_lock:
+        return list(reversed(_saved.values()))
+
+
+def profile_path(profile_id: str, extension: str) -> str | None:
+    """Returns the path of a saved profile file ("prof" or "json"), None if there is no such profile."""
+    if profile_id not in _saved:
+        return None
+    path = os.path.join(PROFILE_DIR, f"{profile_id}.{extension}")
+    return path if os.path.exists(path) else None
+
+
+def get_profile(profile_id: str) -> dict | None:
+    """Returns the summary of a saved profile with its SQL statements and slowest functions, None if there is no such profile."""
+    path = profile_path(profile_id, "json")
+    if path is None:
+        return None
+    with open(path) as f:
+        return json.load(f)
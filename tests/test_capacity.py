@@ -0,0 +1,122 @@
+from db import operations
+from db.dbconfig import Container, Shelf
+from db.routing import write_engine
+from sqlalchemy.orm import Session
+from sqlalchemy import select
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import pytest
+
+# Concurrent writes must never take a container over its max_capacity or a shelf over its max_load_capacity.
+WORKERS = 8
+
+
+def new_product(name: str, cleanup: dict, unit_size: int = 1, unit_weight: float = 0) -> str:
+    product_id = operations.create_new_product(name=name, description="test", unit_size=unit_size, unit_weight=unit_weight)
+    cleanup["products"].append(product_id)
+    return product_id
+
+
+def new_shelf(name: str, cleanup: dict, max_capacity: float, containers: int) -> tuple[str, list[str]]:
+    shelf_id = operations.create_new_shelf(name=name, max_capacity=max_capacity)
+    cleanup["shelves"].append(shelf_id)
+    container_ids = operations.create_new_container(name=name, max_capacity=1000, quantity=containers)
+    cleanup["containers"].extend(container_ids)
+    operations.add_containers_to_shelf([{"container_id": x, "shelf_id": shelf_id} for x in container_ids])
+    return shelf_id, container_ids
+
+
+def add_concurrently(product_id: str, container_ids: list[str], attempts: int) -> int:
+    """Adds one unit of a product `attempts` times from WORKERS threads, spread over the containers. Returns how many were added."""
+    def add(container_id):
+        try:
+            operations.add_product_to_container(product_id, container_id, 1)
+            return True
+        except ValueError:
+            return False
+
+    targets = list(itertools.islice(itertools.cycle(container_ids), attempts))
+    with ThreadPoolExecutor(WORKERS) as executor:
+        return sum(executor.map(add, targets))
+
+
+def shelf_load(shelf_id: str) -> float:
+    shelves = operations.snapshot_shelves([shelf_id])
+    return shelves[0]["used_load_capacity"]
+
+
+def test_container_never_goes_over_its_max_capacity(unique_name, cleanup):
+    product_id = new_product(unique_name, cleanup, unit_size=1)
+    container_id = operations.create_new_container(name=unique_name, max_capacity=10, quantity=1)[0]
+    cleanup["containers"].append(container_id)
+
+    added = add_concurrently(product_id, [container_id], attempts=40)
+
+    assert added == 10
+    container = operations.snapshot_containers([container_id])[0]
+    assert container["used_capacity"] == 10
+    assert sum(x["quantity"] for x in container["products"]) == 10
+
+
+def test_shelf_never_goes_over_its_max_load_capacity(unique_name, cleanup):
+    product_id = new_product(unique_name, cleanup, unit_weight=1)
+    shelf_id, container_ids = new_shelf(unique_name, cleanup, max_capacity=30, containers=6)
+
+    added = add_concurrently(product_id, container_ids, attempts=120)
+
+    # containers busy with another write keep their reservation, so a nearly full shelf may turn down a few adds
+    assert added <= 30
+    assert shelf_load(shelf_id) == added
+
+    # once the writes are done every reservation can go back, the shelf fills up to exactly its max_load_capacity
+    for container_id in itertools.cycle(container_ids):
+        try:
+            operations.add_product_to_container(product_id, container_id, 1)
+        except ValueError:
+            break
+    assert shelf_load(shelf_id) == 30
+
+    with Session(write_engine()) as session:
+        reserved = session.scalar(select(Shelf.reserved_load).where(Shelf.shelf_id == shelf_id))
+        containers = session.scalars(select(Container.reserved_load).where(Container.container_id.in_(container_ids))).all()
+    # reservations never go over the shelf, and they hold at least the weight
+    assert reserved == pytest.approx(30)
+    assert sum(containers) == pytest.approx(30)
+
+
+def test_shelf_reports_what_it_holds_not_what_it_reserved(unique_name, cleanup):
+    product_id = new_product(unique_name, cleanup, unit_weight=1)
+    shelf_id, (container_id,) = new_shelf(unique_name, cleanup, max_capacity=100, containers=1)
+
+    # the container outgrows its (empty) reservation and reserves twice its weight
+    operations.add_product_to_container(product_id, container_id, 30)
+
+    with Session(write_engine()) as session:
+        assert session.scalar(select(Shelf.reserved_load).where(Shelf.shelf_id == shelf_id)) == 60
+    assert shelf_load(shelf_id) == 30
+    assert operations.sync_changes()["columns"]["shelves"] == ["shelf_id", "shelf_name", "max_load_capacity"]
+
+
+def test_shelf_refuses_containers_heavier_than_its_room(unique_name, cleanup):
+    product_id = new_product(unique_name, cleanup, unit_weight=1)
+    shelf_id, (on_shelf,) = new_shelf(unique_name, cleanup, max_capacity=30, containers=1)
+    operations.add_product_to_container(product_id, on_shelf, 20)
+
+    # two containers of 10 and 15 racing for the 10 left on the shelf: only the lighter one fits
+    loose = operations.create_new_container(name=unique_name, max_capacity=1000, quantity=2)
+    cleanup["containers"].extend(loose)
+    operations.add_product_to_container(product_id, loose[0], 10)
+    operations.add_product_to_container(product_id, loose[1], 15)
+
+    def shelve(container_id):
+        try:
+            operations.add_containers_to_shelf([{"container_id": container_id, "shelf_id": shelf_id}])
+            return container_id
+        except ValueError:
+            return None
+
+    with ThreadPoolExecutor(2) as executor:
+        shelved = [x for x in executor.map(shelve, loose) if x is not None]
+
+    assert shelved == [loose[0]]
+    assert shelf_load(shelf_id) == 30
@@ -0,0 +1,125 @@
+from db import idempotency, operations
+from db.dbconfig import Container, IdempotencyKey
+from db.routing import write_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import select, delete, func
+from datetime import timedelta
+import secrets
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def table(monkeypatch):
+    """Shares the keys through the idempotency_keys table, every test starts like a new api process."""
+    monkeypatch.setattr(idempotency, "IDEMPOTENCY_TABLE", True)
+    monkeypatch.setattr(idempotency, "WAIT_SECONDS", 0.5)
+    idempotency._entries.clear()
+    yield
+    idempotency._entries.clear()
+
+
+def other_process():
+    """Forgets the keys kept in memory, like a retry reaching another api process."""
+    idempotency._entries.clear()
+
+
+def count_containers(name: str) -> int:
+    with Session(write_engine()) as session:
+        return session.scalar(select(func.count()).select_from(Container).where(Container.container_name == name))
+
+
+def create(name: str, cleanup: dict):
+    def function():
+        identifiers = operations.create_new_container(name=name, max_capacity=10, quantity=2)
+        cleanup["containers"].extend(identifiers)
+        return identifiers
+    return function
+
+
+def test_retry_replays_the_first_response(unique_name, cleanup):
+    key = secrets.token_hex(8)
+    first, replayed = idempotency.run_once("POST /container", key, {"name": unique_name}, create(unique_name, cleanup))
+    assert not replayed
+
+    other_process()
+    second, replayed = idempotency.run_once("POST /container", key, {"name": unique_name}, create(unique_name, cleanup))
+    assert replayed
+    assert second == first
+    assert count_containers(unique_name) == 2
+
+
+def test_key_reused_for_a_different_request(unique_name, cleanup):
+    key = secrets.token_hex(8)
+    idempotency.run_once("POST /container", key, {"name": unique_name}, create(unique_name, cleanup))
+
+    other_process()
+    with pytest.raises(idempotency.KeyReusedError):
+        idempotency.run_once("POST /container", key, {"name": "something else"}, create(unique_name, cleanup))
+
+
+def test_failed_request_runs_again(unique_name, cleanup):
+    key = secrets.token_hex(8)
+
+    def fail():
+        raise ValueError("Not enough room")
+
+    with pytest.raises(ValueError):
+        idempotency.run_once("POST /container", key, {"name": unique_name}, fail)
+
+    other_process()
+    _, replayed = idempotency.run_once("POST /container", key, {"name": unique_name}, create(unique_name, cleanup))
+    assert not replayed
+    assert count_containers(unique_name) == 2
+
+
+def test_lost_response_is_not_run_again(unique_name, cleanup, monkeypatch):
+    # the claim would be freed right away if the write did not keep it
+    monkeypatch.setattr(idempotency, "PENDING_TTL", timedelta(0))
+
+    def lose_response(claim, response):
+        raise ConnectionError("The database went away")
+
+    key = secrets.token_hex(8)
+    with monkeypatch.context() as m:
+        m.setattr(idempotency, "_store", lose_response)
+        idempotency.run_once("POST /container", key, {"name": unique_name}, create(unique_name, cleanup))
+
+    other_process()
+    with pytest.raises(idempotency.KeyInProgressError):
+        idempotency.run_once("POST /container", key, {"name": unique_name}, create(unique_name, cleanup))
+    assert count_containers(unique_name) == 2
+
+
+def test_write_of_a_freed_claim_is_rolled_back(unique_name, cleanup):
+    key = secrets.token_hex(8)
+
+    def freed_then_create():
+        # another process frees the claim while the write runs (and would run the key itself)
+        with write_engine().begin() as connection:
+            connection.execute(delete(IdempotencyKey).where(IdempotencyKey.idempotency_key == f"POST /container {key}"))
+        return create(unique_name, cleanup)()
+
+    with pytest.raises(idempotency.KeyInProgressError):
+        idempotency.run_once("POST /container", key, {"name": unique_name}, freed_then_create)
+    assert count_containers(unique_name) == 0
+
+
+def test_failed_commit_runs_again(unique_name, cleanup):
+    key = secrets.token_hex(8)
+    containers = operations.create_new_container(name=unique_name, max_capacity=10, quantity=1)
+    cleanup["containers"].extend(containers)
+
+    def duplicate():
+        # the same container twice, the commit fails on the unique container_id
+        with Session(write_engine()) as session:
+            session.add(Container(container_id=containers[0], container_name=unique_name, max_capacity=10))
+            session.commit()
+
+    with pytest.raises(IntegrityError):
+        idempotency.run_once("POST /container", key, {"name": unique_name}, duplicate)
+
+    other_process()
+    _, replayed = idempotency.run_once("POST /container", key, {"name": unique_name}, create(unique_name, cleanup))
+    assert not replayed
+    assert count_containers(unique_name) == 3
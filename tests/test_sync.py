@@ -0,0 +1,114 @@
+from db import operations
+from db.dbconfig import Container
+from db.routing import write_engine
+from sqlalchemy.orm import Session
+from sqlalchemy import text
+import secrets
+import pytest
+
+
+def current_cursor() -> str:
+    """A cursor right before every transaction that has not finished yet, later writes come after it."""
+    with write_engine().connect() as connection:
+        xmin = connection.scalar(text("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint"))
+    return f"{xmin}-0"
+
+
+def sync_all(cursor: str, limit: int = 1000) -> tuple[str, list[dict]]:
+    """Syncs until has_more is False, returns the last cursor and every page."""
+    pages = []
+    while True:
+        page = operations.sync_changes(cursor=cursor, limit=limit)
+        pages.append(page)
+        cursor = page["cursor"]
+        if not page["has_more"]:
+            return cursor, pages
+
+
+def synced_containers(pages: list[dict], container_ids: list[str]) -> list[str]:
+    """The given containers in the order the pages sent them (twice if they were sent twice)."""
+    return [row[0] for page in pages for row in page["changes"].get("containers", []) if row[0] in container_ids]
+
+
+def deleted_containers(pages: list[dict], container_ids: list[str]) -> list[str]:
+    return [x for page in pages for x in page["deleted"].get("containers", []) if x in container_ids]
+
+
+def test_changes_are_sent_once(unique_name, cleanup):
+    start = current_cursor()
+    container_ids = operations.create_new_container(name=unique_name, max_capacity=10, quantity=3)
+    cleanup["containers"].extend(container_ids)
+
+    cursor, pages = sync_all(start)
+    assert sorted(synced_containers(pages, container_ids)) == sorted(container_ids)
+
+    _, pages = sync_all(cursor)
+    assert synced_containers(pages, container_ids) == []
+
+
+def test_small_pages_send_every_change_once(unique_name, cleanup):
+    start = current_cursor()
+    container_ids = []
+    for _ in range(3):
+        container_ids += operations.create_new_container(name=unique_name, max_capacity=10, quantity=3)
+    cleanup["containers"].extend(container_ids)
+
+    _, pages = sync_all(start, limit=2)
+    assert sorted(synced_containers(pages, container_ids)) == sorted(container_ids)
+    assert all(len(sum(page["changes"].values(), [])) + len(sum(page["deleted"].values(), [])) <= 2 for page in pages)
+
+
+def test_updated_rows_are_sent_again(unique_name, cleanup):
+    product_id = operations.create_new_product(name=unique_name, description="test")
+    cleanup["products"].append(product_id)
+    container_id = operations.create_new_container(name=unique_name, max_capacity=10, quantity=1)[0]
+    cleanup["containers"].append(container_id)
+    cursor, _ = sync_all(current_cursor())
+
+    operations.add_product_to_container(product_id, container_id, 4)
+
+    _, pages = sync_all(cursor)
+    rows = [row for page in pages for row in page["changes"].get("containers", []) if row[0] == container_id]
+    columns = operations.SYNC_COLUMNS["containers"]
+    assert [row[columns.index("used_capacity")] for row in rows] == [4]
+    lines = [row for page in pages for row in page["changes"].get("container_contents", []) if row[1] == container_id]
+    assert [row[3] for row in lines] == [4]
+
+
+def test_deleted_rows_are_sent_as_tombstones(unique_name, cleanup):
+    container_ids = operations.create_new_container(name=unique_name, max_capacity=10, quantity=2)
+    cursor, _ = sync_all(current_cursor())
+
+    operations.delete_container(container_ids[:1])
+    cleanup["containers"].extend(container_ids[1:])
+
+    _, pages = sync_all(cursor)
+    assert deleted_containers(pages, container_ids) == container_ids[:1]
+    assert synced_containers(pages, container_ids) == []
+
+
+def test_late_commit_is_not_skipped(unique_name, cleanup):
+    start = current_cursor()
+    early_id = f"c{secrets.token_hex(16)}"
+
+    # a transaction that started writing first but commits last
+    with Session(write_engine()) as early:
+        early.add(Container(container_id=early_id, container_name=unique_name, max_capacity=10))
+        early.flush()
+        late_ids = operations.create_new_container(name=unique_name, max_capacity=10, quantity=1)
+        cleanup["containers"].extend(late_ids)
+
+        # the committed write can not be sent yet, the cursor would move past the running one
+        cursor, pages = sync_all(start)
+        assert synced_containers(pages, late_ids + [early_id]) == []
+
+        early.commit()
+    cleanup["containers"].append(early_id)
+
+    _, pages = sync_all(cursor)
+    assert synced_containers(pages, late_ids + [early_id]) == [early_id] + late_ids
+
+
+def test_invalid_cursor():
+    with pytest.raises(ValueError):
+        operations.sync_changes(cursor="yesterday")